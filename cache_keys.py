@@ -0,0 +1,18 @@
+import os
+import json
+import hashlib
+
+def file_digest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def content_keyed_path(cache_dir, source_path, suffix="", **key):
+    """Path under cache_dir for data derived from source_path.
+
+    The name is the source's stem plus a hash of its content and of `key` (every
+    other setting the derived data depends on), so an edited source or a changed
+    setting never reuses a stale cache.
+    """
+    blob = json.dumps({"source": file_digest(source_path), **key}, sort_keys=True)
+    stem = os.path.splitext(os.path.basename(source_path))[0]
+    return os.path.join(cache_dir, f"{stem}_{hashlib.sha256(blob.encode()).hexdigest()[:16]}{suffix}")
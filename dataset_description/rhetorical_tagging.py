@@ -4,11 +4,12 @@ import os
 import argparse
 import re
 import json
-import spacy
-nlp = spacy.load("en_core_web_sm")
 
 import ollama
 
+# Run from the repo root: python -m dataset_description.rhetorical_tagging
+from sentence_segments import load_sentences
+
 def remove_think_content(text):
     # remove all <think>...</think> and its content (including multi-line)
     return re.sub(r"<think>.*?</think>", "", text, flags=re.DOTALL | re.IGNORECASE).strip()
@@ -31,13 +32,13 @@ else:
     TESTSET_PATH = f"data/paper_html_10.1038/abs_annotation/test_{abstract_type}.tsv"
 test_df = pd.read_csv(TESTSET_PATH, sep="\t")
 test_abstracts = test_df["abstract"].tolist()
+# spaCy (en_core_web_sm) sentences from the shared segmentation cache
+test_sentences = load_sentences(TESTSET_PATH, test_abstracts, "spacy")
 
 with open(OUTPUT_PATH, "a", encoding="utf-8") as f_out:
     for i in tqdm.tqdm(range(start_index, len(test_abstracts)), desc="Tagging abstract sentences", 
                         total=len(test_abstracts)-start_index, unit="annotation"):
-        doc = nlp(test_abstracts[i])
-        assert doc.has_annotation("SENT_START")
-        sents = [sent.text for sent in doc.sents]
+        sents = test_sentences[i]
 
         prompt_payload = {
         "sentence_count": len(sents),
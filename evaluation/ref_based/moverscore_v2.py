@@ -3,50 +3,91 @@ import numpy as np
 import torch
 import string
 import os
-from pyemd import emd, emd_with_flow
+import hashlib
+import shutil
 from torch import nn
 from math import log
 from itertools import chain
 
 from collections import defaultdict, Counter
-from multiprocessing import Pool
+from multiprocessing import Pool, current_process
 from functools import partial
 
 from tqdm import tqdm
 
 
-from transformers import AutoTokenizer, AutoModel
-
-device = os.environ.get('MOVERSCORE_DEVICE', 'cuda:0')
+device = os.environ.get('MOVERSCORE_DEVICE') or ('cuda:0' if torch.cuda.is_available() else 'cpu')
 
 if os.environ.get('MOVERSCORE_MODEL'):
     model_name = os.environ.get('MOVERSCORE_MODEL')
 else:
     model_name = 'distilbert-base-uncased'
-tokenizer = AutoTokenizer.from_pretrained(model_name, do_lower_case=True)
-print("tokenizer.model_max_length: ", tokenizer.model_max_length)
-model = AutoModel.from_pretrained(model_name, output_hidden_states=True, output_attentions=True)
-model.eval()
-model.to(device)
-
-def truncate(tokens):
-    if len(tokens) > tokenizer.model_max_length - 2:
-        tokens = tokens[0:(tokenizer.model_max_length - 2)]
+
+# Encoder autocast precision, 'fp16' or 'bf16' (unset: full precision)
+autocast_dtype = {'fp16': torch.float16, 'bf16': torch.bfloat16}.get(os.environ.get('MOVERSCORE_AUTOCAST', '').lower())
+
+# Set to reuse reference embeddings across word_mover_score calls (see RefEmbeddingCache)
+ref_cache_dir = os.environ.get('MOVERSCORE_REF_CACHE')
+
+# Per-process caches; models are keyed by pid so a forked worker never reuses its parent's CUDA model
+_tokenizers = {}
+_models = {}
+
+class MoverScorer:
+    """Tokenizer and encoder for one model and device, loaded on first use.
+
+    The scorer itself only holds the model name, device and autocast dtype, so it
+    pickles cheaply and each pool worker loads the model once, the first time it scores.
+    """
+
+    def __init__(self, model_name=model_name, device=device, autocast_dtype=autocast_dtype):
+        self.model_name = model_name
+        self.device = device
+        self.autocast_dtype = autocast_dtype
+
+    @property
+    def tokenizer(self):
+        if self.model_name not in _tokenizers:
+            from transformers import AutoTokenizer
+            _tokenizers[self.model_name] = AutoTokenizer.from_pretrained(self.model_name, do_lower_case=True)
+        return _tokenizers[self.model_name]
+
+    @property
+    def model(self):
+        key = (os.getpid(), self.model_name, self.device)
+        if key not in _models:
+            from transformers import AutoModel
+            # Eager attention keeps scores identical to the output_attentions=True encoder of the original
+            model = AutoModel.from_pretrained(self.model_name, attn_implementation="eager")
+            model.eval()
+            _models[key] = model.to(self.device)
+        return _models[key]
+
+def __getattr__(name):
+    # model and tokenizer used to be loaded at import time; keep them reachable as module attributes
+    if name in ('model', 'tokenizer'):
+        return getattr(MoverScorer(), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def truncate(tokens, max_length):
+    if len(tokens) > max_length - 2:
+        tokens = tokens[0:(max_length - 2)]
     return tokens
 
-def process(a):
-    a = ["[CLS]"]+truncate(tokenizer.tokenize(a))+["[SEP]"]
+def process(a, scorer):
+    tokenizer = scorer.tokenizer
+    a = ["[CLS]"]+truncate(tokenizer.tokenize(a), tokenizer.model_max_length)+["[SEP]"]
     a = tokenizer.convert_tokens_to_ids(a)
     return set(a)
 
 
-def get_idf_dict(arr, nthreads=4):
+def get_idf_dict(arr, nthreads=4, scorer=None):
     idf_count = Counter()
     num_docs = len(arr)
 
-    process_partial = partial(process)
+    process_partial = partial(process, scorer=scorer or MoverScorer())
 
-    if nthreads <= 1:
+    if nthreads <= 1 or current_process().daemon:
         # Serial fallback — avoids daemonic-child restriction inside mp.Pool workers
         idf_count.update(chain.from_iterable(map(process_partial, arr)))
     else:
@@ -71,18 +112,15 @@ def bert_encode(model, x, attention_mask):
     model.eval()
     with torch.no_grad():
         result = model(x, attention_mask = attention_mask)
-    if model_name == 'distilbert-base-uncased':
-        return result[1] 
-    else:
-        return result[2] 
+    return result.last_hidden_state
 
 #with open('stopwords.txt', 'r', encoding='utf-8') as f:
 #    stop_words = set(f.read().strip().split(' '))
 
 def collate_idf(arr, tokenize, numericalize, idf_dict,
-                pad="[PAD]",device=device):
+                pad="[PAD]",device=device, max_length=512):
     
-    tokens = [["[CLS]"]+truncate(tokenize(a))+["[SEP]"] for a in arr]  
+    tokens = [["[CLS]"]+truncate(tokenize(a), max_length)+["[SEP]"] for a in arr]  
     arr = [numericalize(a) for a in tokens]
 
     idf_weights = [[idf_dict[i] for i in a] for a in arr]
@@ -98,25 +136,43 @@ def collate_idf(arr, tokenize, numericalize, idf_dict,
     return padded, padded_idf, lens, mask, tokens
 
 def get_bert_embedding(all_sens, model, tokenizer, idf_dict,
-                       batch_size=-1,device=device):
+                       batch_size=-1,device=device, autocast_dtype=None, return_ids=False):
 
     padded_sens, padded_idf, lens, mask, tokens = collate_idf(all_sens,
                                                       tokenizer.tokenize, tokenizer.convert_tokens_to_ids,
-                                                      idf_dict,device=device)
+                                                      idf_dict,device=device,
+                                                      max_length=tokenizer.model_max_length)
 
     if batch_size == -1: batch_size = len(all_sens)
 
-    embeddings = []
-    with torch.no_grad():
+    # Encode in buckets of similar length, each padded only to its own longest
+    # sentence, and scatter the last layer back into the original order
+    order = torch.argsort(lens, descending=True)
+    total_embedding = None
+    with torch.no_grad(), torch.autocast(torch.device(device).type, dtype=autocast_dtype,
+                                         enabled=autocast_dtype is not None):
         for i in range(0, len(all_sens), batch_size):
-            batch_embedding = bert_encode(model, padded_sens[i:i+batch_size],
-                                          attention_mask=mask[i:i+batch_size])
-            batch_embedding = torch.stack(batch_embedding)
-            embeddings.append(batch_embedding)
+            bucket = order[i:i+batch_size]
+            bucket_len = int(lens[bucket].max())
+            batch_embedding = bert_encode(model, padded_sens[bucket, :bucket_len],
+                                          attention_mask=mask[bucket, :bucket_len]).float()
+            if total_embedding is None:
+                total_embedding = torch.zeros(len(all_sens), padded_sens.shape[1], batch_embedding.shape[-1],
+                                              device=batch_embedding.device)
+            total_embedding[bucket, :bucket_len] = batch_embedding
             del batch_embedding
 
-    total_embedding = torch.cat(embeddings, dim=-3)
-    return total_embedding, lens, mask, padded_idf, tokens
+    # Leading layer axis kept for callers that index [-1]
+    if return_ids:
+        return total_embedding.unsqueeze(0), lens, mask, padded_idf, tokens, padded_sens
+    return total_embedding.unsqueeze(0), lens, mask, padded_idf, tokens
+
+def token_mask_table(tokenizer, stop_words):
+    """Boolean lookup over vocab ids: True for stopwords, '##' subwords and punctuation."""
+    stop_words = set(stop_words)
+    punctuation = set(string.punctuation)
+    vocab = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+    return torch.tensor([w in stop_words or '##' in w or w in punctuation for w in vocab])
 
 def _safe_divide(numerator, denominator):
     return numerator / (denominator + 1e-30)
@@ -132,60 +188,213 @@ def batched_cdist_l2(x1, x2):
     ).add_(x1_norm).clamp_min_(1e-30).sqrt_()
     return res
 
+def _transport_cost(problem):
+    """EMD between the ref and hyp tokens that carry mass, given their ref x hyp distances.
+
+    Supply sits only on ref tokens and demand only on hyp tokens, so the optimal flow
+    never uses ref-ref or hyp-hyp distances; those blocks are left at zero.
+    """
+    from pyemd import emd
+
+    ref_weights, hyp_weights, dst = problem
+    n_ref, n_hyp = len(ref_weights), len(hyp_weights)
+    if n_ref == 0 or n_hyp == 0:
+        return 0.
+    c1 = np.zeros(n_ref + n_hyp)
+    c2 = np.zeros(n_ref + n_hyp)
+    c1[:n_ref] = _safe_divide(ref_weights, np.sum(ref_weights))
+    c2[n_ref:] = _safe_divide(hyp_weights, np.sum(hyp_weights))
+    distance = np.zeros((n_ref + n_hyp, n_ref + n_hyp))
+    distance[:n_ref, n_ref:] = dst
+    distance[n_ref:, :n_ref] = dst.T
+    return emd(c1, c2, distance)
+
+class RefEmbeddingCache:
+    """Last-layer token embeddings of reference texts, stored on disk under cache_dir.
+
+    Entries are keyed by the model name and a hash of each text, so every system
+    scored against the same references reuses them. Each update() that meets new
+    texts writes one shard (embeddings.npy, ids.npy, offsets.npy, keys.txt), and
+    shards are memory-mapped when read. IDF weights and stopword masks are not
+    stored: they are recomputed from the token ids for each idf_dict and stop_words.
+    """
+
+    def __init__(self, cache_dir, scorer):
+        self.scorer = scorer
+        name = scorer.model_name.replace('/', '--')
+        if scorer.autocast_dtype is not None:
+            name += '_' + str(scorer.autocast_dtype).replace('torch.', '')
+        self.root = os.path.join(cache_dir, name)
+        self.shards = []
+        self.index = {}   # text hash -> (shard, row)
+        if os.path.isdir(self.root):
+            for name in sorted(os.listdir(self.root)):
+                if '.' not in name:   # skips shards still being written
+                    self._open_shard(os.path.join(self.root, name))
+
+    @staticmethod
+    def key(text):
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def _open_shard(self, path):
+        shard = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+                 for name in ('embeddings', 'ids', 'offsets')}
+        with open(os.path.join(path, 'keys.txt')) as f:
+            keys = f.read().split()
+        self.shards.append(shard)
+        for row, key in enumerate(keys):
+            self.index.setdefault(key, (len(self.shards) - 1, row))
+
+    def update(self, texts, batch_size=128, encode_batch_size=32):
+        """Encodes the texts that are not cached yet and writes them, batch by batch, into a new shard."""
+        missing = list(dict.fromkeys(t for t in texts if self.key(t) not in self.index))
+        if not missing:
+            return
+        model, tokenizer = self.scorer.model, self.scorer.tokenizer
+        keys = [self.key(t) for t in missing]
+        path = os.path.join(self.root, hashlib.sha256(' '.join(keys).encode()).hexdigest()[:16])
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        os.makedirs(tmp_path, exist_ok=True)
+
+        # Sized from the token counts up front, so each encoded batch goes straight to disk
+        lens = [len(truncate(tokenizer.tokenize(t), tokenizer.model_max_length)) + 2 for t in missing]
+        offsets = np.concatenate([[0], np.cumsum(lens)]).astype(np.int64)
+        np.save(os.path.join(tmp_path, 'offsets.npy'), offsets)
+        embeddings = ids = None
+        for start in tqdm(range(0, len(missing), batch_size), desc="Encoding references"):
+            embedding, batch_lens, _, _, _, padded_ids = get_bert_embedding(
+                missing[start:start+batch_size], model, tokenizer, defaultdict(float),
+                batch_size=encode_batch_size, device=self.scorer.device,
+                autocast_dtype=self.scorer.autocast_dtype, return_ids=True)
+            embedding = embedding[-1].cpu().numpy()
+            padded_ids = padded_ids.cpu().numpy()
+            if embeddings is None:
+                embeddings = np.lib.format.open_memmap(os.path.join(tmp_path, 'embeddings.npy'), mode='w+',
+                                                       dtype=np.float32, shape=(int(offsets[-1]), embedding.shape[-1]))
+                ids = np.lib.format.open_memmap(os.path.join(tmp_path, 'ids.npy'), mode='w+',
+                                                dtype=np.int64, shape=(int(offsets[-1]),))
+            for i, n in enumerate(batch_lens.tolist()):
+                row_start = offsets[start + i]
+                embeddings[row_start:row_start + n] = embedding[i, :n]
+                ids[row_start:row_start + n] = padded_ids[i, :n]
+        embeddings.flush()
+        ids.flush()
+        del embeddings, ids
+
+        with open(os.path.join(tmp_path, 'keys.txt'), 'w') as f:
+            f.write('\n'.join(keys))
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Another process wrote the same shard first; its content is identical
+            shutil.rmtree(tmp_path)
+        self._open_shard(path)
+
+    def get_embedding(self, texts, idf_dict, device=device):
+        """Padded last-layer embeddings, IDF weights and token ids of cached texts."""
+        entries = []
+        for text in texts:
+            shard, row = self.index[self.key(text)]
+            start, end = self.shards[shard]['offsets'][row:row+2]
+            entries.append((self.shards[shard]['embeddings'][start:end], self.shards[shard]['ids'][start:end].tolist()))
+
+        max_len = max(len(ids) for _, ids in entries)
+        embedding = torch.zeros(len(entries), max_len, entries[0][0].shape[1])
+        for i, (token_embedding, ids) in enumerate(entries):
+            embedding[i, :len(ids)] = torch.from_numpy(np.array(token_embedding))
+        idf, _, _ = padding([[idf_dict[i] for i in ids] for _, ids in entries], 0, dtype=torch.float)
+        padded_ids, _, _ = padding([ids for _, ids in entries], 0, dtype=torch.long)
+        return embedding.to(device=device), idf, padded_ids.to(device=device)
+
 def word_mover_score(refs, hyps, idf_dict_ref, idf_dict_hyp, stop_words=[], n_gram=1, remove_subwords = True, 
-                     batch_size=128,device=device):
-    preds = []
-    for batch_start in tqdm(range(0, len(refs), batch_size), desc="Calculating WMS", total=len(refs)//batch_size+1):
-        batch_refs = refs[batch_start:batch_start+batch_size]
-        batch_hyps = hyps[batch_start:batch_start+batch_size]
-        
-        ref_embedding, ref_lens, ref_masks, ref_idf, ref_tokens = get_bert_embedding(batch_refs, model, tokenizer, idf_dict_ref,device=device)
-        hyp_embedding, hyp_lens, hyp_masks, hyp_idf, hyp_tokens = get_bert_embedding(batch_hyps, model, tokenizer, idf_dict_hyp,device=device)
-
-        ref_embedding = ref_embedding[-1]
-        hyp_embedding = hyp_embedding[-1]
-        batch_size = len(ref_tokens)
-        for i in range(batch_size):  
-            ref_ids = [k for k, w in enumerate(ref_tokens[i]) 
-                                if w in stop_words or '##' in w 
-                                or w in set(string.punctuation)]
-            hyp_ids = [k for k, w in enumerate(hyp_tokens[i]) 
-                                if w in stop_words or '##' in w
-                                or w in set(string.punctuation)]
-          
-            ref_embedding[i, ref_ids,:] = 0                        
-            hyp_embedding[i, hyp_ids,:] = 0
+                     batch_size=128,device=device, nthreads=4, scorer=None, ref_cache_dir=ref_cache_dir,
+                     encode_batch_size=32):
+    # The encoder runs on the requested device; an explicit scorer brings its own
+    scorer = scorer or MoverScorer(device=device)
+    model, tokenizer, device = scorer.model, scorer.tokenizer, scorer.device
+
+    # Which vocab ids are ignored is decided once, then looked up for whole batches
+    ignored = token_mask_table(tokenizer, stop_words).to(device=device)
+
+    # With a cache, references are encoded once and later calls only encode hypotheses
+    ref_cache = None
+    if ref_cache_dir:
+        ref_cache = RefEmbeddingCache(ref_cache_dir, scorer)
+        ref_cache.update(refs, batch_size, encode_batch_size)
+
+    # Daemonic pool workers cannot start a pool of their own, so they solve serially
+    pool = None
+    if nthreads > 1 and not current_process().daemon:
+        pool = Pool(nthreads)
+    pending = []
+    try:
+        for batch_start in tqdm(range(0, len(refs), batch_size), desc="Calculating WMS", total=len(refs)//batch_size+1):
+            batch_refs = refs[batch_start:batch_start+batch_size]
+            batch_hyps = hyps[batch_start:batch_start+batch_size]
             
-            ref_idf[i, ref_ids] = 0
-            hyp_idf[i, hyp_ids] = 0
-            
-        raw = torch.cat([ref_embedding, hyp_embedding], 1)
-                             
-        raw.div_(torch.norm(raw, dim=-1).unsqueeze(-1) + 1e-30) 
-        
-        distance_matrix = batched_cdist_l2(raw, raw).double().cpu().numpy()
-
-        for i in range(batch_size):
-            c1 = np.zeros(raw.shape[1], dtype=float)
-            c2 = np.zeros(raw.shape[1], dtype=float)
-            c1[:len(ref_idf[i])] = ref_idf[i]
-            c2[len(ref_idf[i]):] = hyp_idf[i]
-            
-            c1 = _safe_divide(c1, np.sum(c1))
-            c2 = _safe_divide(c2, np.sum(c2))
-            
-            dst = distance_matrix[i]
-            _, flow = emd_with_flow(c1, c2, dst)
-            flow = np.array(flow, dtype=np.float32)
-            score = 1./(1. + np.sum(flow * dst))#1 - np.sum(flow * dst)
-            preds.append(score)
+            if ref_cache is not None:
+                ref_embedding, ref_idf, ref_ids = ref_cache.get_embedding(batch_refs, idf_dict_ref, device=device)
+            else:
+                ref_embedding, ref_lens, ref_masks, ref_idf, ref_tokens, ref_ids = get_bert_embedding(batch_refs, model, tokenizer, idf_dict_ref,
+                                                                                                      batch_size=encode_batch_size, device=device,
+                                                                                                      autocast_dtype=scorer.autocast_dtype,
+                                                                                                      return_ids=True)
+                ref_embedding = ref_embedding[-1]
+            hyp_embedding, hyp_lens, hyp_masks, hyp_idf, hyp_tokens, hyp_ids = get_bert_embedding(batch_hyps, model, tokenizer, idf_dict_hyp,
+                                                                                                  batch_size=encode_batch_size, device=device,
+                                                                                                  autocast_dtype=scorer.autocast_dtype,
+                                                                                                  return_ids=True)
+
+            hyp_embedding = hyp_embedding[-1]
+            batch_size = len(ref_ids)
+
+            ref_ignored = ignored[ref_ids]
+            hyp_ignored = ignored[hyp_ids]
+            ref_embedding.masked_fill_(ref_ignored.unsqueeze(-1), 0)
+            hyp_embedding.masked_fill_(hyp_ignored.unsqueeze(-1), 0)
+            ref_idf.masked_fill_(ref_ignored.cpu(), 0)
+            hyp_idf.masked_fill_(hyp_ignored.cpu(), 0)
+
+            ref_embedding.div_(torch.norm(ref_embedding, dim=-1).unsqueeze(-1) + 1e-30)
+            hyp_embedding.div_(torch.norm(hyp_embedding, dim=-1).unsqueeze(-1) + 1e-30)
+
+            # Only the ref x hyp block of the distance matrix enters the transport problem
+            distance_matrix = batched_cdist_l2(ref_embedding, hyp_embedding).double().cpu().numpy()
+            ref_idf = ref_idf.double().numpy()
+            hyp_idf = hyp_idf.double().numpy()
+
+            problems = []
+            for i in range(batch_size):
+                # Masked tokens and padding carry no mass and drop out of the problem
+                ref_pos = np.flatnonzero(ref_idf[i] > 0)
+                hyp_pos = np.flatnonzero(hyp_idf[i] > 0)
+                problems.append((ref_idf[i, ref_pos], hyp_idf[i, hyp_pos],
+                                 distance_matrix[i][np.ix_(ref_pos, hyp_pos)]))
+
+            # Solved in the background while the next batch is encoded
+            if pool is not None:
+                pending.append(pool.map_async(_transport_cost, problems,
+                                              chunksize=max(1, len(problems) // (4 * nthreads))))
+            else:
+                pending.append(list(map(_transport_cost, problems)))
+
+        preds = []
+        for costs in pending:
+            costs = costs.get() if pool is not None else costs
+            preds.extend(1./(1. + cost) for cost in costs)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
     return preds
 
-import matplotlib.pyplot as plt
-
 def plot_example(is_flow, reference, translation, device=device):
-    
+    import matplotlib.pyplot as plt
+    from pyemd import emd_with_flow
+
+    scorer = MoverScorer(device=device)
+    model, tokenizer = scorer.model, scorer.tokenizer
     idf_dict_ref = defaultdict(lambda: 1.) 
     idf_dict_hyp = defaultdict(lambda: 1.)
     
@@ -1,47 +1,267 @@
 import os
+import json
+import time
 import argparse
+import difflib
+import random
+import shutil
 import torch
 import torch.multiprocessing as mp
 import pandas as pd
 import tqdm
 from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
 
+from memory_stats import max_rss_mb, peak_memory_mb
+
 os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
 
 CHECKPOINT_DIR   = "data/BART/checkpoints/best_model"
 MAX_INPUT        = 1024
 MAX_NEW_TOKENS   = 128
+NUM_BEAMS        = 4
 DEFAULT_BATCH    = 64   # ~14 GB KV cache on L40 (46 GB), well within budget
+BACKENDS         = ["torch", "torch_fp32", "int8", "onnx"]
+CPU_BACKENDS     = ["int8", "onnx"]
+
+
+def _load_onnx(ckpt: str):
+    # Exported once to <checkpoint>_onnx (encoder + decoder with KV cache) and reused
+    try:
+        from optimum.onnxruntime import ORTModelForSeq2SeqLM
+    except ImportError as e:
+        raise ImportError("--backend onnx needs: pip install optimum[onnxruntime]") from e
+    onnx_dir = ckpt.rstrip("/") + "_onnx"
+    if os.path.isdir(onnx_dir):
+        return ORTModelForSeq2SeqLM.from_pretrained(onnx_dir, use_cache=True)
+    print(f"Exporting {ckpt} to ONNX at {onnx_dir} ...")
+    model = ORTModelForSeq2SeqLM.from_pretrained(ckpt, export=True, use_cache=True)
+    model.save_pretrained(onnx_dir)
+    return model
+
 
+def load_model(ckpt: str, device: str, backend: str = "torch"):
+    """Loads the fine-tuned tokenizer and model with our generation settings.
 
-def _worker(rank: int, gpu_id: int, abstracts: list, ckpt: str,
-            batch_size: int, tmp_path: str):
-    """Runs generation on a single GPU and writes results to tmp_path."""
-    device = f"cuda:{gpu_id}"
+    Backends: torch (bf16, the default), torch_fp32, int8 (PyTorch dynamic int8
+    quantisation of the Linear layers, CPU only) and onnx (ONNX Runtime, CPU only).
+    """
     tokenizer = AutoTokenizer.from_pretrained(ckpt, local_files_only=True)
-    model = AutoModelForSeq2SeqLM.from_pretrained(
-        ckpt, local_files_only=True, dtype=torch.bfloat16
-    ).to(device).eval()
+    if backend == "onnx":
+        model = _load_onnx(ckpt)
+    else:
+        dtype = torch.bfloat16 if backend == "torch" else torch.float32
+        model = AutoModelForSeq2SeqLM.from_pretrained(
+            ckpt, local_files_only=True, dtype=dtype
+        ).to(device).eval()
+        if backend == "int8":
+            model = torch.ao.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8
+            )
     model.generation_config.min_length = 0
     model.generation_config.no_repeat_ngram_size = 0
+    return tokenizer, model
+
+
+def make_batches(lengths: list, batch_size: int, token_budget: int = None) -> list:
+    """Groups row indices into generation batches.
+
+    Without a token budget: fixed-size batches in file order (the original
+    behaviour). With one: rows are sorted by tokenised length, longest first, and
+    a batch grows while rows × longest row stays within token_budget padded input
+    tokens (and rows <= batch_size), so short abstracts are no longer padded to a
+    long neighbour. Longest-first also means an OOM shows up in the first batch.
+    """
+    if not token_budget:
+        return [list(range(i, min(i + batch_size, len(lengths))))
+                for i in range(0, len(lengths), batch_size)]
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    batches, batch = [], []
+    for i in order:
+        # Rows arrive longest first, so the batch's padded length is its first row's
+        if batch and (len(batch) >= batch_size
+                      or (len(batch) + 1) * lengths[batch[0]] > token_budget):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def token_lengths(tokenizer, abstracts: list) -> list:
+    encoded = tokenizer(abstracts, max_length=MAX_INPUT, truncation=True)
+    return [len(ids) for ids in encoded["input_ids"]]
+
+
+def generate_batch(model, tokenizer, batch: list, device: str,
+                   max_new_tokens: int = MAX_NEW_TOKENS, num_beams: int = NUM_BEAMS,
+                   early_stopping=None, return_token_counts: bool = False) -> list:
+    inputs = tokenizer(
+        batch, return_tensors="pt",
+        max_length=MAX_INPUT, truncation=True, padding=True,
+    ).to(device)
+    decoding = {"max_new_tokens": max_new_tokens, "num_beams": num_beams}
+    if early_stopping is not None and num_beams > 1:
+        decoding["early_stopping"] = early_stopping
+    with torch.no_grad():
+        outputs = model.generate(**inputs, **decoding)
+    decoded = tokenizer.batch_decode(outputs, skip_special_tokens=True)
+    texts = [" ".join(t.split()) for t in decoded]
+    if return_token_counts:
+        # Generated tokens per row, not counting padding, BOS/EOS or the decoder start token
+        special = torch.tensor(tokenizer.all_special_ids, device=outputs.device)
+        counts = (~torch.isin(outputs, special)).sum(dim=1).tolist()
+        return texts, counts
+    return texts
+
+
+def timed_generate(model, tokenizer, abstracts: list, batch_size: int, device: str):
+    """Generates in fixed-size batches; returns (texts, samples per second)."""
+    start_time = time.perf_counter()
+    texts = []
+    for i in range(0, len(abstracts), batch_size):
+        texts.extend(generate_batch(model, tokenizer, abstracts[i : i + batch_size], device))
+    return texts, len(abstracts) / max(time.perf_counter() - start_time, 1e-9)
+
+
+def parity_check(ckpt: str, backend: str, abstracts: list, batch_size: int,
+                 reference_path: str, start_index: int):
+    """Compares a backend's outputs with reference outputs and reports throughput."""
+    device = "cpu" if backend in CPU_BACKENDS or not torch.cuda.is_available() else "cuda:0"
+    if reference_path:
+        with open(reference_path, encoding="utf-8") as f:
+            lines = f.read().splitlines()
+        reference = lines[start_index : start_index + len(abstracts)]
+        if len(reference) < len(abstracts):
+            raise ValueError(f"{reference_path} has only {len(reference)} rows from {start_index}")
+        reference_label = reference_path
+    else:
+        tokenizer, model = load_model(ckpt, "cpu", "torch_fp32")
+        reference, reference_rate = timed_generate(model, tokenizer, abstracts, batch_size, "cpu")
+        reference_label = f"torch_fp32 on cpu ({reference_rate:.2f} samples/s)"
+        del model
+
+    tokenizer, model = load_model(ckpt, device, backend)
+    candidate, rate = timed_generate(model, tokenizer, abstracts, batch_size, device)
+
+    exact = sum(c == r for c, r in zip(candidate, reference))
+    similarity = sum(difflib.SequenceMatcher(None, c.split(), r.split()).ratio()
+                     for c, r in zip(candidate, reference)) / max(len(abstracts), 1)
+    print(f"Reference   : {reference_label}")
+    print(f"Backend     : {backend} on {device}  |  {rate:.2f} samples/s")
+    print(f"Parity      : {exact}/{len(abstracts)} identical  |  mean token similarity {similarity:.4f}")
+
+
+def benchmark_decoding(ckpt: str, backend: str, device: str, abstracts: list,
+                       references: list, batch_size: int, token_budget: int,
+                       beam_widths: list, max_new_tokens_values: list,
+                       early_stopping_values: list, output_csv: str):
+    """Generates the same sample under every decoding setting in the grid.
+
+    Reports samples/s, peak memory (CUDA only), mean summary length and ROUGE
+    against the reference annotations, one row per setting, and writes the table
+    to output_csv.
+    Greedy decoding is num_beams=1 (early stopping does not apply to it).
+    """
+    import evaluate
+    rouge = evaluate.load("rouge")
+    tokenizer, model = load_model(ckpt, device, backend)
+    batches = make_batches(token_lengths(tokenizer, abstracts), batch_size, token_budget)
 
-    results = []
-    for batch_start in tqdm.tqdm(
-        range(0, len(abstracts), batch_size),
-        desc=f"GPU {gpu_id}", position=rank, leave=True, unit="batch",
-    ):
-        batch = abstracts[batch_start : batch_start + batch_size]
-        inputs = tokenizer(
-            batch, return_tensors="pt",
-            max_length=MAX_INPUT, truncation=True, padding=True,
-        ).to(device)
-        with torch.no_grad():
-            outputs = model.generate(**inputs, max_new_tokens=MAX_NEW_TOKENS, num_beams=4)
-        decoded = tokenizer.batch_decode(outputs, skip_special_tokens=True)
-        results.extend(" ".join(t.split()) for t in decoded)
-
-    with open(tmp_path, "w", encoding="utf-8") as f:
-        f.write("\n".join(results) + ("\n" if results else ""))
+    # Warm-up, so the first setting does not pay for kernel selection and allocator growth
+    generate_batch(model, tokenizer, [abstracts[i] for i in batches[0]], device,
+                   max_new_tokens=8, num_beams=1)
+
+    grid = []
+    for num_beams in beam_widths:
+        for max_new_tokens in max_new_tokens_values:
+            for early_stopping in (early_stopping_values if num_beams > 1 else [None]):
+                grid.append((num_beams, max_new_tokens, early_stopping))
+
+    rows = []
+    for num_beams, max_new_tokens, early_stopping in grid:
+        if device.startswith("cuda"):
+            torch.cuda.synchronize(device)
+            torch.cuda.reset_peak_memory_stats(device)
+        texts = [None] * len(abstracts)
+        start_time = time.perf_counter()
+        for batch in batches:
+            outputs = generate_batch(model, tokenizer, [abstracts[i] for i in batch], device,
+                                     max_new_tokens=max_new_tokens, num_beams=num_beams,
+                                     early_stopping=early_stopping)
+            for i, text in zip(batch, outputs):
+                texts[i] = text
+        if device.startswith("cuda"):
+            torch.cuda.synchronize(device)
+        elapsed = time.perf_counter() - start_time
+
+        scores = rouge.compute(predictions=texts, references=references, use_stemmer=True)
+        row = {
+            "num_beams": num_beams,
+            "max_new_tokens": max_new_tokens,
+            "early_stopping": "-" if early_stopping is None else str(early_stopping),
+            "samples_per_s": len(abstracts) / max(elapsed, 1e-9),
+        }
+        # On CPU there is no per-setting peak to report, only the run's RSS high-water mark below
+        if device.startswith("cuda"):
+            row["peak_mem_mb"] = peak_memory_mb(device)
+        rows.append({
+            **row,
+            "mean_words": sum(len(t.split()) for t in texts) / max(len(texts), 1),
+            **{k: round(v * 100, 2) for k, v in scores.items()},
+        })
+        print(f"beams={num_beams} max_new_tokens={max_new_tokens} early_stopping={early_stopping}: "
+              f"{rows[-1]['samples_per_s']:.2f} samples/s, rougeL {rows[-1]['rougeL']}")
+
+    table = pd.DataFrame(rows)
+    print(table.to_string(index=False, float_format=lambda x: f"{x:.2f}"))
+    if not device.startswith("cuda"):
+        print(f"Max RSS over the whole run (all settings): {max_rss_mb():.0f} MB")
+    table.to_csv(output_csv, index=False)
+    print(f"Saved to {output_csv}")
+
+
+def _worker(rank: int, device: str, ckpt: str, backend: str, work_queue,
+            store_dir: str, n_threads: int):
+    """Pulls batches from the shared queue until it sees None.
+
+    Each finished batch is written to its own file in store_dir, so a crashed
+    worker only loses the batch it was working on.
+    """
+    if device == "cpu":
+        torch.set_num_threads(n_threads)
+    tokenizer, model = load_model(ckpt, device, backend)
+
+    pbar = tqdm.tqdm(desc=f"{device} #{rank}", position=rank, leave=True, unit="batch")
+    while True:
+        item = work_queue.get()
+        if item is None:
+            break
+        rows, batch = item
+        texts = generate_batch(model, tokenizer, batch, device)
+        write_batch_result(store_dir, rows, texts)
+        pbar.update(1)
+    pbar.close()
+
+
+def write_batch_result(store_dir: str, rows: list, texts: list):
+    # Write-then-rename, so a batch file is either complete or absent
+    path = os.path.join(store_dir, f"{rows[0]:08d}_{len(rows)}.json")
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"rows": rows, "texts": texts}, f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+
+def load_batch_results(store_dir: str) -> dict:
+    """Returns {row: text} for every batch already in the result store."""
+    results = {}
+    for name in os.listdir(store_dir):
+        if not name.endswith(".json"):
+            continue
+        with open(os.path.join(store_dir, name), encoding="utf-8") as f:
+            record = json.load(f)
+        results.update(zip(record["rows"], record["texts"]))
+    return results
 
 
 def main():
@@ -58,8 +278,34 @@ def main():
     parser.add_argument("--batch_size", type=int, default=DEFAULT_BATCH,
                         help=f"Per-GPU batch size (default: {DEFAULT_BATCH}; "
                              "safe up to ~128 on L40 46 GB with num_beams=4)")
+    parser.add_argument("--token_budget", type=int, default=None,
+                        help="Sort abstracts by length and size each batch by padded input tokens "
+                             "(e.g. 16384) instead of a fixed --batch_size, which then caps rows per batch")
     parser.add_argument("--gpus", type=int, nargs="+", default=[0],
                         help="GPU indices to use, e.g. --gpus 0 1 2 3")
+    parser.add_argument("--backend", default="torch", choices=BACKENDS,
+                        help="Inference backend: torch (bf16, default), torch_fp32, "
+                             "int8 (dynamic quantisation, CPU) or onnx (ONNX Runtime, CPU)")
+    parser.add_argument("--parity_samples", type=int, default=0,
+                        help="Instead of generating the output, compare --backend against a reference "
+                             "on the first N rows and report agreement and throughput")
+    parser.add_argument("--parity_reference", default=None,
+                        help="Reference outputs for --parity_samples (an existing generated .txt); "
+                             "default: fp32 PyTorch generated in-process")
+    parser.add_argument("--benchmark_samples", type=int, default=0,
+                        help="Instead of generating the output, run the decoding grid below on N randomly "
+                             "sampled rows and report samples/s, peak memory and ROUGE per setting")
+    parser.add_argument("--benchmark_seed", type=int, default=0,
+                        help="Seed for the --benchmark_samples row sample (default: 0)")
+    parser.add_argument("--bench_beams", type=int, nargs="+", default=[1, 2, 4],
+                        help="Beam widths to benchmark; 1 is greedy (default: 1 2 4)")
+    parser.add_argument("--bench_max_new_tokens", type=int, nargs="+", default=[64, 96, MAX_NEW_TOKENS],
+                        help=f"max_new_tokens values to benchmark (default: 64 96 {MAX_NEW_TOKENS})")
+    parser.add_argument("--bench_early_stopping", nargs="+", default=["false", "true"],
+                        choices=["false", "true", "never"],
+                        help="Beam-search early_stopping settings to benchmark (default: false true)")
+    parser.add_argument("--cpu_workers", type=int, default=0,
+                        help="Run N CPU worker processes instead of GPUs (N > 1 uses the shared work queue)")
     args = parser.parse_args()
 
     # ── Output path (mirrors gen_llm_sum.py naming convention) ────────────────
@@ -78,72 +324,126 @@ def main():
 
     ckpt          = os.path.abspath(args.checkpoint)
     gpu_ids       = args.gpus
-    n_gpus        = len(gpu_ids)
+    devices       = (["cpu"] * args.cpu_workers if args.cpu_workers > 0
+                     else [f"cuda:{gpu_id}" for gpu_id in gpu_ids])
+    if args.backend in CPU_BACKENDS and args.cpu_workers == 0:
+        devices = ["cpu"]
     abstracts_todo = abstracts[args.start_index:]
 
     print(f"Checkpoint  : {ckpt}")
-    print(f"GPUs        : {gpu_ids}  |  batch_size per GPU: {args.batch_size}")
-    print(f"Samples     : {len(abstracts_todo)}  |  Output: {output_path}")
+    print(f"Devices     : {devices}  |  batch_size per device: {args.batch_size}"
+          + (f"  |  token_budget: {args.token_budget}" if args.token_budget else ""))
+    print(f"Samples     : {len(abstracts_todo)}  |  Output: {output_path}  |  backend: {args.backend}")
 
-    if n_gpus == 1:
-        # ── Single-GPU path: append mode supports --start_index resume ────────
-        gpu_id = gpu_ids[0]
-        device = f"cuda:{gpu_id}" if torch.cuda.is_available() else "cpu"
-        tokenizer = AutoTokenizer.from_pretrained(ckpt, local_files_only=True)
-        model = AutoModelForSeq2SeqLM.from_pretrained(
-            ckpt, local_files_only=True, dtype=torch.bfloat16
-        ).to(device).eval()
-        model.generation_config.min_length = 0
-        model.generation_config.no_repeat_ngram_size = 0
+    if args.parity_samples > 0:
+        parity_check(ckpt, args.backend, abstracts_todo[:args.parity_samples],
+                     args.batch_size, args.parity_reference, args.start_index)
+        return
 
+    if args.benchmark_samples > 0:
+        rows = range(args.start_index, len(abstracts))
+        sample = sorted(random.Random(args.benchmark_seed).sample(
+            rows, min(args.benchmark_samples, len(rows))))
+        early_stopping = {"false": False, "true": True, "never": "never"}
+        device = "cpu" if devices[0] == "cpu" or not torch.cuda.is_available() else devices[0]
+        benchmark_decoding(
+            ckpt, args.backend, device,
+            [abstracts[row] for row in sample],
+            test_df["annotation"].fillna("").astype(str).iloc[sample].tolist(),
+            args.batch_size, args.token_budget,
+            args.bench_beams, args.bench_max_new_tokens,
+            [early_stopping[v] for v in args.bench_early_stopping],
+            os.path.join(result_dir, f"{args.model_name}{suffix}_decoding_benchmark.csv"),
+        )
+        return
+
+    if len(devices) == 1 and not args.token_budget:
+        # ── Single-device path: append mode supports --start_index resume ─────
+        device = devices[0] if torch.cuda.is_available() else "cpu"
+        tokenizer, model = load_model(ckpt, device, args.backend)
+        # Fixed-size batches in file order need no lengths, so skip tokenising the test set
+        batches = [list(range(i, min(i + args.batch_size, len(abstracts_todo))))
+                   for i in range(0, len(abstracts_todo), args.batch_size)]
+
+        # Batches run in file order, so each one extends the output directly
+        start_time = time.perf_counter()
         with open(output_path, "a", encoding="utf-8") as f_out:
-            for batch_start in tqdm.tqdm(
-                range(0, len(abstracts_todo), args.batch_size),
-                desc=f"GPU {gpu_id}", unit="batch",
-            ):
-                batch = abstracts_todo[batch_start : batch_start + args.batch_size]
-                inputs = tokenizer(
-                    batch, return_tensors="pt",
-                    max_length=MAX_INPUT, truncation=True, padding=True,
-                ).to(device)
-                with torch.no_grad():
-                    outputs = model.generate(
-                        **inputs, max_new_tokens=MAX_NEW_TOKENS, num_beams=4,
-                    )
-                decoded = tokenizer.batch_decode(outputs, skip_special_tokens=True)
-                for text in decoded:
-                    f_out.write(" ".join(text.split()) + "\n")
+            for batch in tqdm.tqdm(batches, desc=device, unit="batch"):
+                texts = generate_batch(model, tokenizer, [abstracts_todo[i] for i in batch], device)
+                for text in texts:
+                    f_out.write(text + "\n")
                 f_out.flush()
+        elapsed = time.perf_counter() - start_time
+        print(f"Throughput  : {len(abstracts_todo) / max(elapsed, 1e-9):.2f} samples/s "
+              f"({len(batches)} batches in {elapsed:.1f}s)")
 
     else:
-        # ── Multi-GPU path: split work across GPUs, merge afterwards ─────────
-        chunk_size = (len(abstracts_todo) + n_gpus - 1) // n_gpus
-        chunks     = [abstracts_todo[i * chunk_size : (i + 1) * chunk_size]
-                      for i in range(n_gpus)]
-        tmp_paths  = [f"{output_path}.part{i}" for i in range(n_gpus)]
-
-        processes = []
-        for rank, (gpu_id, chunk, tmp_path) in enumerate(
-            zip(gpu_ids, chunks, tmp_paths)
-        ):
-            p = mp.Process(
-                target=_worker,
-                args=(rank, gpu_id, chunk, ckpt, args.batch_size, tmp_path),
-            )
-            p.start()
-            processes.append(p)
+        # ── Result store path: several workers, or length-sorted batches ──────
+        # Batches finish out of file order, so each one lands in a result store
+        # next to the output and a rerun only generates the rows still missing.
+        store_dir = f"{output_path}.batches"
+        os.makedirs(store_dir, exist_ok=True)
+        rows_todo = list(range(args.start_index, len(abstracts)))
+        done = load_batch_results(store_dir)
+        pending = [row for row in rows_todo if row not in done]
+        print(f"Result store: {store_dir}  |  {len(rows_todo) - len(pending)} rows done, "
+              f"{len(pending)} to generate")
 
-        for p in processes:
-            p.join()
-            if p.exitcode != 0:
-                raise RuntimeError(f"Worker process exited with code {p.exitcode}")
+        tokenizer = AutoTokenizer.from_pretrained(ckpt, local_files_only=True)
+        pending_abstracts = [abstracts[row] for row in pending]
+        batches = make_batches(token_lengths(tokenizer, pending_abstracts),
+                               args.batch_size, args.token_budget)
+
+        failed = []
+        start_time = time.perf_counter()
+        if len(devices) == 1:
+            device = devices[0] if torch.cuda.is_available() else "cpu"
+            tokenizer, model = load_model(ckpt, device, args.backend)
+            for batch in tqdm.tqdm(batches, desc=device, unit="batch"):
+                texts = generate_batch(model, tokenizer, [pending_abstracts[i] for i in batch], device)
+                write_batch_result(store_dir, [pending[i] for i in batch], texts)
+        else:
+            work_queue = mp.Queue()
+            for batch in batches:
+                work_queue.put(([pending[i] for i in batch], [pending_abstracts[i] for i in batch]))
+            for _ in devices:
+                work_queue.put(None)
+            # Do not block interpreter exit on batches left behind by crashed workers
+            work_queue.cancel_join_thread()
+
+            n_threads = max(1, (os.cpu_count() or 1) // len(devices))
+            processes = []
+            for rank, device in enumerate(devices):
+                p = mp.Process(
+                    target=_worker,
+                    args=(rank, device, ckpt, args.backend, work_queue, store_dir, n_threads),
+                )
+                p.start()
+                processes.append(p)
+
+            for rank, p in enumerate(processes):
+                p.join()
+                if p.exitcode != 0:
+                    failed.append((devices[rank], p.exitcode))
+        elapsed = time.perf_counter() - start_time
+
+        done = load_batch_results(store_dir)
+        missing = [row for row in rows_todo if row not in done]
+        if missing:
+            raise RuntimeError(
+                f"{len(missing)} rows missing after worker failure(s) {failed}; "
+                f"finished batches are kept in {store_dir}, rerun the same command to resume"
+            )
+        if failed:
+            print(f"Warning: worker(s) {failed} failed; the other workers finished their batches")
+        print(f"Throughput  : {len(pending) / max(elapsed, 1e-9):.2f} samples/s "
+              f"({len(batches)} batches on {len(devices)} workers in {elapsed:.1f}s)")
 
-        # Merge parts in order (append after any existing lines from start_index)
+        # Merge in row order (append after any existing lines from start_index)
         with open(output_path, "a", encoding="utf-8") as f_out:
-            for tmp_path in tmp_paths:
-                with open(tmp_path, "r", encoding="utf-8") as f_in:
-                    f_out.write(f_in.read())
-                os.remove(tmp_path)
+            for row in rows_todo:
+                f_out.write(done[row] + "\n")
+        shutil.rmtree(store_dir)
 
     print("Done.")
 
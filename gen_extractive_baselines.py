@@ -5,57 +5,181 @@ Generates four baselines for each abstract in the test set:
   - lead1     : first sentence
   - last1     : last sentence
   - textrank  : highest-PageRank sentence (TF-IDF cosine similarity graph)
-  - ext_oracle: sentence with highest ROUGE-L vs reference (extractive upper bound)
+  - ext_oracle: sentence with highest ROUGE-L vs reference (extractive upper bound);
+                with --oracle_k K > 1 also ext_oracle{K}, a greedy K-sentence oracle
 
 Outputs one .txt file per baseline in generated_annotations/, matching the
 line-per-row format used by gen_llm_sum.py and gen_bart_sum.py.
+
+All abstracts are sentence-split up front (sentence_segments.py caches the
+NLTK offsets, computed in a process pool), and TextRank runs
+batched: one TF-IDF pass over every sentence, then PageRank by power iteration
+on stacked similarity matrices of abstracts with the same sentence count.
 """
 
 import argparse
 import os
 import re
+from collections import defaultdict
 import numpy as np
 import pandas as pd
-import networkx as nx
-from nltk.tokenize import sent_tokenize
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
-from evaluate import load as load_metric
+from scipy.sparse import csr_matrix
+from sklearn.feature_extraction.text import CountVectorizer
+from sklearn.preprocessing import normalize
+from rouge_score.tokenizers import DefaultTokenizer
 import tqdm
 
+from sentence_segments import load_sentences
+
 RESULT_DIR = "data/paper_html_10.1038/abs_annotation/generated_annotations"
 
 
 # ── Sentence splitting ─────────────────────────────────────────────────────────
-def split_sentences(text: str) -> list[str]:
-    sents = sent_tokenize(text)
-    return [s.strip() for s in sents if s.strip()]
+def split_all(test_path: str, abstracts: list[str], workers: int = None) -> list[list[str]]:
+    # NLTK sentences from the shared segmentation cache; an abstract without any
+    # sentence is used whole
+    split = load_sentences(test_path, abstracts, "nltk", workers)
+    split = [[s.strip() for s in sents if s.strip()] for sents in split]
+    return [sents or [abstract] for sents, abstract in zip(split, abstracts)]
 
 
 # ── TextRank ───────────────────────────────────────────────────────────────────
-def textrank_best(sentences: list[str]) -> str:
-    if len(sentences) == 1:
-        return sentences[0]
+def tfidf_rows(sentence_lists: list[list[str]]):
+    """L2-normalised TF-IDF rows for every sentence of every abstract.
+
+    Equivalent to fitting TfidfVectorizer() on each abstract's sentences
+    separately: counts come from one CountVectorizer over all sentences, and the
+    smoothed idf uses each abstract's own sentence count and document frequency.
+    Returns the (n_sentences × n_terms) matrix and the row offset of each abstract.
+    """
+    sentences = [s for sents in sentence_lists for s in sents]
+    sizes     = np.array([len(sents) for sents in sentence_lists])
+    offsets   = np.concatenate([[0], np.cumsum(sizes)])
     try:
-        tfidf = TfidfVectorizer().fit_transform(sentences)
-        sim = cosine_similarity(tfidf)
-        np.fill_diagonal(sim, 0)
-        G = nx.from_numpy_array(sim)
-        scores = nx.pagerank(G, max_iter=200)
-        return sentences[max(scores, key=scores.get)]
-    except Exception:
-        return sentences[0]
+        counts = CountVectorizer().fit_transform(sentences).tocoo()
+    except ValueError:  # no token anywhere: every row stays zero
+        return csr_matrix((len(sentences), 1)), offsets
+
+    abstract_of_row = np.repeat(np.arange(len(sentence_lists)), sizes)[counts.row]
+    # One entry per (sentence, term), so counting (abstract, term) pairs gives the df
+    pair = abstract_of_row.astype(np.int64) * counts.shape[1] + counts.col
+    _, inverse, df = np.unique(pair, return_inverse=True, return_counts=True)
+    n_docs = sizes[abstract_of_row]
+    idf = np.log((1 + n_docs) / (1 + df[inverse])) + 1
+    tfidf = csr_matrix((counts.data * idf, (counts.row, counts.col)), shape=counts.shape)
+    return normalize(tfidf), offsets
+
+
+def pagerank_batched(weights: np.ndarray, alpha: float = 0.85, max_iter: int = 200,
+                     tol: float = 1.0e-6):
+    """PageRank of a stack of (n × n) weighted graphs, as networkx.pagerank computes it.
+
+    Uniform start and personalisation, dangling nodes spread uniformly, and a graph
+    stops iterating once its l1 change drops below n * tol. Returns the (B × n)
+    scores and a mask of graphs that converged within max_iter (networkx raises
+    for the others).
+    """
+    n_graphs, n, _ = weights.shape
+    out_weight = weights.sum(axis=2, keepdims=True)
+    dangling   = (out_weight[:, :, 0] == 0).astype(float)
+    transition = np.divide(weights, out_weight, out=np.zeros_like(weights), where=out_weight != 0)
+
+    scores    = np.zeros((n_graphs, n))
+    converged = np.zeros(n_graphs, dtype=bool)
+    active    = np.arange(n_graphs)
+    x = np.full((n_graphs, n), 1.0 / n)
+    for _ in range(max_iter):
+        x_last = x
+        leaked = (x_last * dangling[active]).sum(axis=1, keepdims=True)
+        x = alpha * (np.einsum("bi,bij->bj", x_last, transition[active]) + leaked / n) + (1 - alpha) / n
+        done = np.abs(x - x_last).sum(axis=1) < n * tol
+        if done.any():
+            scores[active[done]] = x[done]
+            converged[active[done]] = True
+            active, x = active[~done], x[~done]
+            if len(active) == 0:
+                break
+    return scores, converged
+
+
+def textrank_all(sentence_lists: list[list[str]]) -> list[str]:
+    """Highest-PageRank sentence of every abstract (first sentence on failure)."""
+    best = [sents[0] for sents in sentence_lists]
+    tfidf, offsets = tfidf_rows(sentence_lists)
+
+    by_size = defaultdict(list)
+    for i, sents in enumerate(sentence_lists):
+        if len(sents) > 1:
+            by_size[len(sents)].append(i)
+    for n, rows in by_size.items():
+        sims = np.stack([
+            (tfidf[offsets[i]:offsets[i + 1]] @ tfidf[offsets[i]:offsets[i + 1]].T).toarray()
+            for i in rows
+        ])
+        sims[:, np.arange(n), np.arange(n)] = 0
+        scores, converged = pagerank_batched(sims)
+        for i, top, ok in zip(rows, scores.argmax(axis=1), converged):
+            if ok:
+                best[i] = sentence_lists[i][top]
+    return best
 
 
 # ── Oracle best sentence (ROUGE-L) ────────────────────────────────────────────
-def oracle_best(sentences: list[str], reference: str, rouge) -> str:
+# Scores are computed as rouge_score does for evaluate's "rouge" metric with
+# use_stemmer=True: same tokenizer, LCS-based precision/recall and F = 2PR/(P+R).
+def position_masks(tokens: list[str]) -> dict:
+    masks = {}
+    for position, token in enumerate(tokens):
+        masks[token] = masks.get(token, 0) | (1 << position)
+    return masks
+
+
+def lcs_length(reference_masks: dict, reference_length: int, tokens: list[str]) -> int:
+    # Bit-parallel LCS (Allison-Dix / Hyyrö): bit j of v is cleared once reference
+    # position j is used by the LCS, so the LCS length is the number of zero bits
+    full = (1 << reference_length) - 1
+    v = full
+    for token in tokens:
+        u = v & reference_masks.get(token, 0)
+        v = ((v + u) | (v - u)) & full
+    return reference_length - v.bit_count()
+
+
+def rouge_l_f(reference_masks: dict, reference_length: int, tokens: list[str]) -> float:
+    if not reference_length or not tokens:
+        return 0.0
+    lcs = lcs_length(reference_masks, reference_length, tokens)
+    precision = lcs / len(tokens)
+    recall    = lcs / reference_length
+    return 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0
+
+
+def oracle_best(sentences: list[str], reference: str, tokenizer, k: int = 1) -> str:
+    """Greedy ROUGE-L oracle of up to k sentences, joined in document order.
+
+    Each step adds the sentence that most improves ROUGE-L of the selection and
+    stops early when none does; k=1 is the single best sentence (first on ties).
+    """
     if len(sentences) == 1:
         return sentences[0]
-    scores = [
-        rouge.compute(predictions=[s], references=[reference], use_stemmer=True)["rougeL"]
-        for s in sentences
-    ]
-    return sentences[int(np.argmax(scores))]
+    reference_tokens = tokenizer.tokenize(reference)
+    masks = position_masks(reference_tokens)
+    sentence_tokens = [tokenizer.tokenize(s) for s in sentences]
+
+    selected, best_score = [], -1.0
+    for _ in range(min(k, len(sentences))):
+        best_i = None
+        for i in range(len(sentences)):
+            if i in selected:
+                continue
+            tokens = [t for j in sorted(selected + [i]) for t in sentence_tokens[j]]
+            score = rouge_l_f(masks, len(reference_tokens), tokens)
+            if score > best_score:
+                best_i, best_score = i, score
+        if best_i is None:
+            break
+        selected.append(best_i)
+    return " ".join(sentences[i] for i in sorted(selected))
 
 
 # ── Main ───────────────────────────────────────────────────────────────────────
@@ -66,6 +190,10 @@ def main():
     parser.add_argument("--baselines", nargs="+",
                         default=["lead1", "last1", "textrank", "ext_oracle"],
                         help="Which baselines to generate")
+    parser.add_argument("--oracle_k", type=int, nargs="+", default=[1],
+                        help="Sentences in the greedy ext_oracle; K > 1 writes ext_oracle{K} (default: 1)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Sentence-splitting processes (default: all CPUs)")
     args = parser.parse_args()
 
     if args.abstract_type == "full":
@@ -80,41 +208,31 @@ def main():
 
     os.makedirs(RESULT_DIR, exist_ok=True)
 
-    # Only load ROUGE if oracle baseline requested
-    rouge = None
-    if "ext_oracle" in args.baselines:
-        rouge = load_metric("rouge")
+    print(f"Generating baselines: {args.baselines}")
+    sentence_lists = split_all(test_path, abstracts, args.workers)
 
-    # Open output files
-    handles = {}
-    for bl in args.baselines:
+    results = {}
+    if "lead1"      in args.baselines:
+        results["lead1"]      = [sents[0] for sents in sentence_lists]
+    if "last1"      in args.baselines:
+        results["last1"]      = [sents[-1] for sents in sentence_lists]
+    if "textrank"   in args.baselines:
+        results["textrank"]   = textrank_all(sentence_lists)
+    if "ext_oracle" in args.baselines:
+        tokenizer = DefaultTokenizer(use_stemmer=True)
+        for k in args.oracle_k:
+            name = "ext_oracle" if k == 1 else f"ext_oracle{k}"
+            results[name] = [
+                oracle_best(sents, annotation, tokenizer, k)
+                for sents, annotation in tqdm.tqdm(
+                    zip(sentence_lists, annotations), total=len(abstracts), unit="row", desc=name
+                )
+            ]
+
+    for bl in results:
         path = os.path.join(RESULT_DIR, f"{bl}{suffix}.txt")
-        handles[bl] = open(path, "w", encoding="utf-8")
-    print(f"Writing baselines: {args.baselines}")
-
-    try:
-        for abstract, annotation in tqdm.tqdm(
-            zip(abstracts, annotations), total=len(abstracts), unit="row"
-        ):
-            sents = split_sentences(abstract)
-            if not sents:
-                sents = [abstract]
-
-            results = {}
-            if "lead1"      in args.baselines:
-                results["lead1"]      = sents[0]
-            if "last1"      in args.baselines:
-                results["last1"]      = sents[-1]
-            if "textrank"   in args.baselines:
-                results["textrank"]   = textrank_best(sents)
-            if "ext_oracle" in args.baselines:
-                results["ext_oracle"] = oracle_best(sents, annotation, rouge)
-
-            for bl, text in results.items():
-                handles[bl].write(" ".join(text.split()) + "\n")
-    finally:
-        for f in handles.values():
-            f.close()
+        with open(path, "w", encoding="utf-8") as f:
+            f.writelines(" ".join(text.split()) + "\n" for text in results[bl])
 
     print("Done.")
 
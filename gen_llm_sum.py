@@ -4,92 +4,683 @@ import tqdm
 import os
 import argparse
 import re
-import nltk
-from nltk.tokenize import word_tokenize
+import json
+import hashlib
+import sqlite3
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from word_count import load_prompt_table
 
-nltk.download('punkt', quiet=True)
 OLLAMA_PORT = '9903'
 OLLAMA_URL = f"http://127.0.0.1:{OLLAMA_PORT}/api/generate"
+ENDPOINT_COOLDOWN = 30.0   # seconds a failing endpoint is skipped before it is retried
+RESULT_DIR = "data/paper_html_10.1038/abs_annotation/generated_annotations"
+CACHE_PATH = "data/cache/ollama_responses.sqlite"
+MODELFILE_DIR = "ollama_model_files"
+
+_thread_local = threading.local()
 
 def remove_think_content(text):
     # Remove all <think>...</think> tags and their content (including multi-line)
     return re.sub(r"<think>.*?</think>", "", text, flags=re.DOTALL | re.IGNORECASE).strip()
 
-def word_count(text):
-    words = word_tokenize(text)
-    return len(words)
+def set_think(payload, model_name):
+    if model_name == 'gpt_oss':
+        payload['think'] = 'low'
+    elif model_name in ['qwen3', 'deepseek_r1', 'gemma4', 'qwen3.6']:
+        payload['think'] = False
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--model_name", type=str, required=True, help="Ollama model name")
-    parser.add_argument("--start_index", type=int, default=0, help="Start processing test data row number (starting from 0)")
+def build_payload(model_name, prompt, ollama_options):
+    payload = {
+        "model": model_name + "_TLDR",
+        "prompt": prompt,
+        "stream": False
+    }
+    if ollama_options:
+        payload["options"] = ollama_options
+    set_think(payload, model_name)
+    return payload
+
+def read_modelfile(model_name):
+    """Returns (base model from FROM, PARAMETER options, SYSTEM/MESSAGE turns as chat
+    messages) of ollama_model_files/<model_name>."""
+    base_model = None
+    parameters = {}
+    messages = []
+    with open(os.path.join(MODELFILE_DIR, model_name), encoding="utf-8") as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) >= 2 and fields[0] == "FROM":
+                base_model = fields[1]
+            elif len(fields) >= 3 and fields[0] == "PARAMETER":
+                value = fields[2]
+                try:
+                    value = int(value)
+                except ValueError:
+                    try:
+                        value = float(value)
+                    except ValueError:
+                        pass
+                parameters[fields[1]] = value
+            elif len(fields) >= 2 and fields[0] == "SYSTEM":
+                messages.append({"role": "system", "content": line.split(None, 1)[1].strip()})
+            elif len(fields) >= 3 and fields[0] == "MESSAGE":
+                messages.append({"role": fields[1], "content": line.split(None, 2)[2].strip()})
+    if base_model is None:
+        raise ValueError(f"No FROM line in the Modelfile for {model_name}")
+    return base_model, parameters, messages
+
+def build_chat_payload(model_name, base_model, chat_prefix, prompt, ollama_options, keep_alive):
+    # Targets the base model: the *_TLDR model would prepend its own few-shot turns
+    payload = {
+        "model": base_model,
+        "messages": chat_prefix + [{"role": "user", "content": prompt}],
+        "stream": False,
+        "keep_alive": keep_alive,
+    }
+    if ollama_options:
+        payload["options"] = ollama_options
+    set_think(payload, model_name)
+    return payload
+
+def message_chars(payload):
+    return sum(len(m["content"]) for m in payload["messages"])
+
+def warm_chat_prefix(endpoints, payload):
+    """Prefills the shared chat prefix on every endpoint before the real rows.
+
+    Returns (prefix tokens, prefix characters), or None tokens if no endpoint
+    answered. prompt_eval_count only counts tokens that were not already in the KV
+    cache, so the prefix is first measured with a probe whose system text starts
+    with a fresh nonce: nothing of it is cached, and the whole prefix is prefilled.
+    """
+    probe = dict(payload, stream=False)
+    probe["messages"] = payload["messages"][:-1] + [{"role": "user", "content": "[Abstract] [Word count: 0]"}]
+    probe["options"] = dict(payload.get("options") or {}, num_predict=1)
+    cold = dict(probe, messages=[dict(m) for m in probe["messages"]])
+    cold["messages"][0]["content"] = f"[{time.time_ns()}] " + cold["messages"][0]["content"]
+    counts = []
+    for url in endpoints.urls:
+        try:
+            # Measure first, then warm: the real prefix must be what is left in the cache
+            for request in (cold, probe):
+                response = _session().post(api_url(url, "/api/chat"), json=request)
+                response.raise_for_status()
+                if request is cold:
+                    counts.append(response.json().get("prompt_eval_count") or 0)
+        except (requests.RequestException, ValueError) as e:
+            tqdm.tqdm.write(f"Prefix warm-up on {url} failed ({e})")
+    return (max(counts) if counts else None), message_chars(cold)
+
+def api_url(url, path):
+    # Swap the /api/generate suffix of a normalised endpoint for another API path
+    return url[:-len("/api/generate")] + path
+
+def normalize_endpoint(endpoint):
+    # Accept "host:port", "http://host:port" or a full ".../api/generate" URL
+    if "://" not in endpoint:
+        endpoint = "http://" + endpoint
+    endpoint = endpoint.rstrip("/")
+    if not endpoint.endswith("/api/generate"):
+        endpoint += "/api/generate"
+    return endpoint
+
+class EndpointPool:
+    """Least-outstanding-requests scheduler over one or more Ollama servers.
+
+    An endpoint that errors is put on cooldown and skipped while healthy
+    endpoints remain; the failed request is retried on another endpoint.
+    """
+
+    def __init__(self, urls, cooldown=ENDPOINT_COOLDOWN):
+        self.urls = [normalize_endpoint(u) for u in urls]
+        self.cooldown = cooldown
+        self.outstanding = {u: 0 for u in self.urls}
+        self.completed = {u: 0 for u in self.urls}
+        self.errors = {u: 0 for u in self.urls}
+        self.failed_until = {u: 0.0 for u in self.urls}
+        self.lock = threading.Lock()
+
+    def acquire(self, exclude=()):
+        with self.lock:
+            candidates = [u for u in self.urls if u not in exclude]
+            if not candidates:
+                return None
+            now = time.monotonic()
+            healthy = [u for u in candidates if self.failed_until[u] <= now]
+            url = min(healthy or candidates, key=lambda u: self.outstanding[u])
+            self.outstanding[url] += 1
+            return url
+
+    def release(self, url, ok):
+        with self.lock:
+            self.outstanding[url] -= 1
+            if ok:
+                self.completed[url] += 1
+                self.failed_until[url] = 0.0
+            else:
+                self.errors[url] += 1
+                self.failed_until[url] = time.monotonic() + self.cooldown
+
+    def summary(self):
+        return "  ".join(f"{u}: {self.completed[u]} ok / {self.errors[u]} err" for u in self.urls)
+
+def _session():
+    # requests.Session is not thread-safe, so every worker thread keeps its own
+    if not hasattr(_thread_local, "session"):
+        _thread_local.session = requests.Session()
+    return _thread_local.session
+
+def consume_stream(response, start_time, think_budget=None):
+    """Reads Ollama's NDJSON stream into a single result like the non-streaming API returns.
+
+    Adds the time to first token and the number of thinking tokens. Thinking comes
+    either in the separate `thinking` field or inline between <think> tags. Once it
+    exceeds `think_budget` tokens the stream is closed and the row is marked aborted.
+    """
+    parts = []
+    result = {}
+    ttft = None
+    think_tokens = 0
+    aborted = False
+    for line in response.iter_lines():
+        if not line:
+            continue
+        chunk = json.loads(line)
+        if chunk.get("error"):
+            raise ValueError(f"Ollama stream error: {chunk['error']}")
+        message = chunk.get("message") or {}
+        text = chunk.get("response") or message.get("content") or ""
+        thinking = chunk.get("thinking") or message.get("thinking") or ""
+        if ttft is None and (text or thinking):
+            ttft = time.perf_counter() - start_time
+        parts.append(text)
+        if text:
+            so_far = "".join(parts).lower()
+            in_think = so_far.rfind("<think>") > so_far.rfind("</think>")
+        else:
+            in_think = False
+        if thinking or in_think:
+            think_tokens += 1
+            if think_budget and think_tokens > think_budget:
+                aborted = True
+                response.close()
+                break
+        if chunk.get("done"):
+            result = chunk
+            break
+    result["response"] = "" if aborted else "".join(parts)
+    if aborted:
+        result["eval_count"] = think_tokens
+    result["ttft_s"] = ttft
+    result["think_tokens"] = think_tokens
+    result["think_aborted"] = aborted
+    return result
+
+def post_generate(endpoints, payload, think_budget=None):
+    """Posts to the least busy endpoint, failing over to the others on error."""
+    tried = []
+    while True:
+        url = endpoints.acquire(exclude=tried)
+        if url is None:
+            raise last_error
+        tried.append(url)
+        target = api_url(url, "/api/chat") if "messages" in payload else url
+        try:
+            start_time = time.perf_counter()
+            if payload.get("stream"):
+                with _session().post(target, json=payload, stream=True) as response:
+                    response.raise_for_status()
+                    result = consume_stream(response, start_time, think_budget)
+            else:
+                response = _session().post(target, json=payload)
+                response.raise_for_status()
+                result = response.json()
+                if "message" in result:
+                    result["response"] = result["message"].get("content", "")
+            result["wall_s"] = time.perf_counter() - start_time
+        except (requests.RequestException, ValueError) as e:
+            endpoints.release(url, ok=False)
+            tqdm.tqdm.write(f"Request to {url} failed ({e}); {len(endpoints.urls) - len(tried)} endpoint(s) left to try")
+            last_error = e
+            continue
+        endpoints.release(url, ok=True)
+        result["endpoint"] = url
+        return result
+
+def response_metrics(result):
+    """Per-row timing metrics from an Ollama response (durations converted to seconds)."""
+    metrics = {
+        "endpoint": result.get("endpoint"),
+        "wall_s": result.get("wall_s"),
+        "ttft_s": result.get("ttft_s"),
+        "prompt_eval_count": result.get("prompt_eval_count"),
+        "eval_count": result.get("eval_count", 0) or 0,
+        "think_tokens": result.get("think_tokens"),
+        "think_aborted": result.get("think_aborted", False),
+    }
+    for name in ("prompt_eval_duration", "eval_duration", "load_duration", "total_duration"):
+        value = result.get(name)
+        metrics[name + "_s"] = value / 1e9 if value is not None else None
+    if metrics["eval_duration_s"]:
+        metrics["decode_tps"] = metrics["eval_count"] / metrics["eval_duration_s"]
+    else:
+        metrics["decode_tps"] = None
+    return metrics
+
+def model_digest(endpoints, model_name, ollama_model):
+    """Identifies the exact Ollama model a run talks to, for cache keys.
+
+    Uses the digest Ollama reports in /api/tags; falls back to hashing the local
+    Modelfile when no endpoint lists the model.
+    """
+    wanted = {ollama_model, ollama_model + ":latest"}
+    for url in endpoints.urls:
+        try:
+            response = _session().get(api_url(url, "/api/tags"), timeout=10)
+            response.raise_for_status()
+            models = response.json().get("models", [])
+        except (requests.RequestException, ValueError):
+            continue
+        for model in models:
+            if model.get("name") in wanted and model.get("digest"):
+                return model["digest"]
+    modelfile = os.path.join(MODELFILE_DIR, model_name)
+    if os.path.exists(modelfile):
+        with open(modelfile, "rb") as f:
+            return "modelfile:" + hashlib.sha256(f.read()).hexdigest()
+    return "unknown"
+
+class ResponseCache:
+    """Persistent content-addressed cache of Ollama responses with LRU eviction.
+
+    Entries are keyed by the model digest plus everything in the request that
+    affects the output (model, prompt, options, think). Once the stored payload
+    exceeds `max_bytes`, the least recently used entries are evicted.
+    """
+
+    def __init__(self, path, digest, max_bytes):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.digest = digest
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS responses ("
+                          "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                          "size INTEGER NOT NULL, last_access REAL NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_lru ON responses(last_access)")
+        self.conn.commit()
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def key(self, payload):
+        blob = json.dumps({"digest": self.digest, **request_fields(payload)}, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+            return json.loads(row[0])
+
+    def put(self, key, result):
+        value = json.dumps(result, ensure_ascii=False)
+        size = len(value.encode("utf-8"))
+        with self.lock:
+            old = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.conn.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                              (key, value, size, time.time()))
+            self.total_bytes += size - (old[0] if old else 0)
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+        # Drop least recently used entries until the cache is back under 90% of its budget
+        target = self.max_bytes * 0.9
+        rows = self.conn.execute("SELECT key, size FROM responses ORDER BY last_access").fetchall()
+        for key, size in rows:
+            if self.total_bytes <= target:
+                break
+            self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.total_bytes -= size
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        rate = self.hits / lookups if lookups else 0.0
+        return (f"{self.hits} hits / {self.misses} misses ({rate:.1%})  |  "
+                f"{self.total_bytes / 2**20:.1f} MB of {self.max_bytes / 2**20:.0f} MB")
+
+def generate_tldr(payload, endpoints, cache=None, think_budget=None):
+    """Sends one generate request, consulting the response cache first.
+
+    Returns (single-line TLDR, metrics dict); metrics["cached"] marks cache hits.
+    """
+    key = cache.key(payload) if cache is not None else None
+    cached_result = cache.get(key) if cache is not None else None
+    if cached_result is not None:
+        text = cached_result["response"]
+        metrics = {"eval_count": cached_result["eval_count"], "cached": True}
+    else:
+        result = post_generate(endpoints, payload, think_budget)
+        text = result.get("response", "") or ""
+        metrics = {**response_metrics(result), "cached": False}
+        if cache is not None and not metrics["think_aborted"]:
+            cache.put(key, {"response": text, "eval_count": metrics["eval_count"]})
+
+    # Remove <think>...</think> parts and collapse the TLDR to a single line
+    filtered_tldr = remove_think_content(text)
+    return " ".join(filtered_tldr.split()), metrics
+
+def request_fields(payload):
+    # The parts of a request that determine its output (transport settings such as
+    # "stream" are left out)
+    return {k: payload.get(k) for k in ("model", "prompt", "messages", "options", "think")}
+
+def row_key(payload):
+    # Identifies a generation request: a journal entry is reused only if model, prompt,
+    # options and think setting are all unchanged
+    blob = json.dumps(request_fields(payload), sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(blob.encode("utf-8")).hexdigest()[:32]
+
+def load_journal(journal_path):
+    """Returns {row: record} from a JSONL journal, ignoring a torn last line."""
+    records = {}
+    if not os.path.exists(journal_path):
+        return records
+    with open(journal_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            records[record["row"]] = record
+    return records
+
+def open_journal(journal_path):
+    """Opens the journal for appending, first cutting off a torn last line.
+
+    Otherwise the next record would be appended to the torn line and be lost
+    with it on every later load.
+    """
+    if os.path.exists(journal_path):
+        with open(journal_path, "rb+") as f:
+            data = f.read()
+            if data and not data.endswith(b"\n"):
+                f.truncate(data.rfind(b"\n") + 1)
+    return open(journal_path, "a", encoding="utf-8")
+
+def append_journal(f_journal, record):
+    f_journal.write(json.dumps(record, ensure_ascii=False) + "\n")
+    f_journal.flush()
+    os.fsync(f_journal.fileno())
+
+def materialise_output(output_path, n_rows, records):
+    """Writes one line per test row (empty for rows not generated yet) via an atomic rename."""
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f_out:
+        for i in range(n_rows):
+            record = records.get(i)
+            f_out.write((record["response"] if record else "") + "\n")
+    os.replace(tmp_path, output_path)
+
+def write_metrics(metrics_path, records):
+    """Writes the per-row metrics kept in the journal to a parquet file."""
+    rows = [{k: v for k, v in record.items() if k not in ("key", "response")}
+            for _, record in sorted(records.items())]
+    pd.DataFrame(rows).to_parquet(metrics_path, index=False)
+
+def run_generation(todo, f_journal, endpoints, concurrency=1, cache=None, think_budget=None):
+    """Keeps up to `concurrency` requests in flight and journals each row as it completes.
+
+    `todo` is a list of (row, key, payload); `cache` (a ResponseCache or None) is
+    consulted before each request. Rows finish in any order; the journal
+    records the row index so the ordered output can be materialised afterwards.
+    On a request failure no new rows are submitted, the in-flight ones are still
+    journaled, and the error is re-raised.
+    Returns (journal records written, tokens generated by the server, elapsed seconds).
+    """
+    new_records = []
+    total_tokens = 0
+    failure = None
+    start_time = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool, \
+         tqdm.tqdm(total=len(todo), desc="Generating TLDR", unit="annotation") as pbar:
+        in_flight = {}
+        next_to_submit = 0
+        while in_flight or (failure is None and next_to_submit < len(todo)):
+            while failure is None and next_to_submit < len(todo) and len(in_flight) < concurrency:
+                row, key, payload = todo[next_to_submit]
+                future = pool.submit(generate_tldr, payload, endpoints, cache, think_budget)
+                in_flight[future] = (row, key)
+                next_to_submit += 1
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                row, key = in_flight.pop(future)
+                try:
+                    tldr, metrics = future.result()
+                except Exception as e:
+                    failure = failure or e
+                    continue
+                record = {"row": row, "key": key, "response": tldr, **metrics}
+                append_journal(f_journal, record)
+                new_records.append(record)
+                if not metrics["cached"]:
+                    total_tokens += metrics["eval_count"]
+                pbar.update(1)
+
+    if failure is not None:
+        raise failure
+    return new_records, total_tokens, time.perf_counter() - start_time
+
+def add_run_args(parser):
+    """Options shared by gen_llm_sum.py and the sweep driver."""
+    parser.add_argument("--start_index", type=int, default=0,
+                        help="Only generate rows from this index on (rows already in the journal are always skipped)")
     parser.add_argument("--abstract_type", type=str, default="full", choices=["sent_shuffle", "tail"], help="Type of abstract to use, default is 'full'")
-    parser.add_argument("--temperature", type=float, default=None,
-                        help="Override model file temperature (e.g. 0.0 for greedy, 1.0 for default)")
-    parser.add_argument("--max_new_tokens", type=int, default=None,
-                        help="Override max tokens to generate (Ollama: num_predict)")
     parser.add_argument("--num_batch", type=int, default=2048, help="Number of abstracts to process in a batch (default: 2048)")
-    args = parser.parse_args()
-    model_name = args.model_name
-    start_index = args.start_index
-    abstract_type = args.abstract_type
-    num_batch = args.num_batch
+    parser.add_argument("--concurrency", type=int, default=1,
+                        help="Number of requests kept in flight across all endpoints "
+                             "(sum of the servers' OLLAMA_NUM_PARALLEL; default: 1)")
+    parser.add_argument("--ollama_urls", type=str, nargs="+", default=[OLLAMA_URL],
+                        help="Ollama endpoints, e.g. --ollama_urls node1:11434 node2:11434 "
+                             f"(default: {OLLAMA_URL})")
+    parser.add_argument("--api", type=str, default="generate", choices=["generate", "chat"],
+                        help="generate: prompt the *_TLDR model; chat: send sys_prompt.txt and icl.tsv turns "
+                             "as a fixed message prefix to the base model so its KV cache is reused")
+    parser.add_argument("--keep_alive", type=str, default="30m",
+                        help="With --api chat, how long Ollama keeps the model and its cache loaded (default: 30m)")
+    parser.add_argument("--stream", action="store_true",
+                        help="Use Ollama's streaming API to record time to first token per row")
+    parser.add_argument("--think_budget", type=int, default=None,
+                        help="With --stream, abort a row once its thinking exceeds this many tokens "
+                             "(the row is written empty and marked think_aborted in the metrics)")
+    parser.add_argument("--cache", type=str, default="deterministic", choices=["off", "deterministic", "all"],
+                        help="Response cache use: only for temperature 0 runs (default), always, or never")
+    parser.add_argument("--cache_path", type=str, default=CACHE_PATH,
+                        help=f"SQLite file backing the response cache (default: {CACHE_PATH})")
+    parser.add_argument("--cache_max_mb", type=float, default=512,
+                        help="Cache size budget before least recently used entries are evicted (default: 512)")
+    parser.add_argument("--adopt_existing", action="store_true",
+                        help="Import the lines of an existing output file without a journal as rows 0..n-1")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="Discard an existing output file that has no journal")
 
-    # Build Ollama options overrides (only include keys explicitly set by user)
-    ollama_options = {}
-    ollama_options["num_batch"] = num_batch
-    if args.temperature is not None:
-        ollama_options["temperature"] = args.temperature
-    if args.max_new_tokens is not None:
-        ollama_options["num_predict"] = args.max_new_tokens
+def check_run_args(parser, args):
+    if args.concurrency < 1:
+        parser.error("--concurrency must be >= 1")
+    if args.think_budget is not None and not args.stream:
+        parser.error("--think_budget requires --stream")
 
+def output_path_for(model_name, abstract_type, temperature=None, max_new_tokens=None):
     # automatically generate result file path based on model name and abstract type
-    result_dir = "data/paper_html_10.1038/abs_annotation/generated_annotations"
     base_name = model_name if abstract_type == "full" else f"{model_name}_{abstract_type}"
     prefix_parts = []
-    if args.temperature is not None:
-        prefix_parts.append(f"tem{args.temperature}")
-    if args.max_new_tokens is not None:
-        prefix_parts.append(f"max{args.max_new_tokens}")
+    if temperature is not None:
+        prefix_parts.append(f"tem{temperature}")
+    if max_new_tokens is not None:
+        prefix_parts.append(f"max{max_new_tokens}")
     prefix = "_".join(prefix_parts) + "_" if prefix_parts else ""
-    output_filename = f"{prefix}{base_name}.txt"
-    OUTPUT_PATH = os.path.join(result_dir, output_filename)
-
-    os.makedirs(result_dir, exist_ok=True)
+    return os.path.join(RESULT_DIR, f"{prefix}{base_name}.txt")
 
+def load_prompts(abstract_type):
     if abstract_type == 'full':
         TESTSET_PATH = "data/paper_html_10.1038/abs_annotation/test.tsv"
     else:
         TESTSET_PATH = f"data/paper_html_10.1038/abs_annotation/test_{abstract_type}.tsv"
-    test_df = pd.read_csv(TESTSET_PATH, sep="\t")
-    test_abstracts = test_df["abstract"].tolist()
-    test_annotations = test_df['annotation'].tolist()
-
-    with open(OUTPUT_PATH, "a", encoding="utf-8") as f_out:
-        for i in tqdm.tqdm(range(start_index, len(test_abstracts)), desc="Generating TLDR", 
-                           total=len(test_abstracts)-start_index, unit="annotation"):
-            payload = {
-                "model": model_name + "_TLDR",
-                "prompt": '[Abstract] ' + test_abstracts[i] + f'[Word count: {word_count(test_annotations[i])}]',
-                "stream": False
-            }
-            if ollama_options:
-                payload["options"] = ollama_options
-            if model_name == 'gpt_oss':
-                payload['think'] = 'low'
-            elif model_name in ['qwen3', 'deepseek_r1', 'gemma4', 'qwen3.6']:
-                payload['think'] = False
-
-            response = requests.post(OLLAMA_URL, json=payload)
-            response.raise_for_status()
-            result = response.json()
-            generated_tldr = result.get("response", "") or ""
+    # Word counts and rendered prompts come from the precomputed prompt table (see word_count.py)
+    return load_prompt_table(TESTSET_PATH)["prompt"].tolist()
+
+def ollama_model_for(args, model_name):
+    # The model name the server sees: the *_TLDR model, or its base model in chat mode
+    if args.api == "chat":
+        return read_modelfile(model_name)[0]
+    return model_name + "_TLDR"
+
+def run_config(args, model_name, temperature, max_new_tokens, prompts, endpoints):
+    """Generates (or resumes) one output file for a model/temperature/num_predict setting.
+
+    Raises FileExistsError for a legacy output file without a journal unless
+    --adopt_existing or --overwrite was given.
+    """
+    # Build Ollama options overrides (only include keys explicitly set by user)
+    ollama_options = {}
+    ollama_options["num_batch"] = args.num_batch
+    if temperature is not None:
+        ollama_options["temperature"] = temperature
+    if max_new_tokens is not None:
+        ollama_options["num_predict"] = max_new_tokens
+
+    OUTPUT_PATH = output_path_for(model_name, args.abstract_type, temperature, max_new_tokens)
+    os.makedirs(RESULT_DIR, exist_ok=True)
+
+    ollama_model = ollama_model_for(args, model_name)
+    if args.api == "chat":
+        # The Modelfile's system prompt and few-shot turns, verbatim, lead every request
+        # unchanged so that Ollama can keep their KV cache between requests
+        _, chat_options, chat_prefix = read_modelfile(model_name)
+        chat_options.update(ollama_options)
+        payloads = [build_chat_payload(model_name, ollama_model, chat_prefix, prompt, chat_options, args.keep_alive)
+                    for prompt in prompts]
+    else:
+        payloads = [build_payload(model_name, prompt, ollama_options) for prompt in prompts]
+    if args.stream:
+        for payload in payloads:
+            payload["stream"] = True
+    keys = [row_key(payload) for payload in payloads]
+
+    # The journal records every completed row; the .txt is rebuilt from it at the end
+    journal_path = OUTPUT_PATH + ".journal.jsonl"
+    metrics_path = OUTPUT_PATH[:-len(".txt")] + "_metrics.parquet"
+    if os.path.exists(OUTPUT_PATH) and not os.path.exists(journal_path):
+        if args.adopt_existing:
+            with open(OUTPUT_PATH, encoding="utf-8") as f_in, \
+                 open(journal_path, "w", encoding="utf-8") as f_journal:
+                for i, line in enumerate(f_in):
+                    if i >= len(keys):
+                        break
+                    append_journal(f_journal, {"row": i, "key": keys[i],
+                                               "response": line.rstrip("\n"), "eval_count": 0})
+        elif not args.overwrite:
+            raise FileExistsError(f"{OUTPUT_PATH} exists without a journal; "
+                                  "pass --adopt_existing to keep its lines or --overwrite to regenerate")
+
+    records = load_journal(journal_path)
+    done_rows = {row for row, record in records.items() if row < len(keys) and record["key"] == keys[row]}
+    todo = [(i, keys[i], payloads[i])
+            for i in range(args.start_index, len(payloads)) if i not in done_rows]
+    print(f"Journal     : {journal_path}  |  {len(done_rows)} rows done, {len(todo)} to generate")
+
+    prefix_tokens = None
+    if args.api == "chat" and todo:
+        prefix_tokens, prefix_chars = warm_chat_prefix(endpoints, todo[0][2])
+    cache = None
+    if args.cache == "all" or (args.cache == "deterministic" and temperature == 0):
+        cache = ResponseCache(args.cache_path, model_digest(endpoints, model_name, ollama_model),
+                              int(args.cache_max_mb * 2**20))
+    try:
+        with open_journal(journal_path) as f_journal:
+            new_records, n_tokens, elapsed = run_generation(todo, f_journal, endpoints,
+                                                            concurrency=args.concurrency, cache=cache,
+                                                            think_budget=args.think_budget)
+    finally:
+        if cache is not None:
+            cache.close()
+        records = load_journal(journal_path)
+        records = {row: r for row, r in records.items() if row < len(keys) and r["key"] == keys[row]}
+        materialise_output(OUTPUT_PATH, len(keys), records)
+        write_metrics(metrics_path, records)
+        missing = len(keys) - len(records)
+        if missing:
+            print(f"Warning: {missing} rows have no generation yet and were written as empty lines; "
+                  "rerun without --start_index to fill them in")
+
+    n_done = len(new_records)
+    elapsed = max(elapsed, 1e-9)
+    print(f"Rows        : {n_done}  |  concurrency: {args.concurrency}  |  wall time: {elapsed:.1f}s")
+    print(f"Throughput  : {n_done / elapsed:.2f} requests/s  |  {n_tokens / elapsed:.1f} tokens/s")
+    print(f"Endpoints   : {endpoints.summary()}")
+    print(f"Cache       : {cache.summary() if cache is not None else 'off'}")
+    served = pd.DataFrame([r for r in new_records if not r["cached"]])
+    if not served.empty:
+        latency = f"median decode {served['decode_tps'].median():.1f} tokens/s"
+        if args.stream:
+            latency = (f"median TTFT {served['ttft_s'].median():.3f}s  |  {latency}  |  "
+                       f"{int(served['think_aborted'].sum())} rows over think budget")
+        print(f"Latency     : {latency}")
+    if prefix_tokens:
+        # Rows prefilled from the KV cache report only the newly evaluated tokens in
+        # prompt_eval_count; full prompt sizes are estimated from the prefix's tokens/char
+        tokens_per_char = prefix_tokens / prefix_chars
+        full_tokens = saved_tokens = 0.0
+        for record in new_records:
+            if record["cached"] or record.get("prompt_eval_count") is None:
+                continue
+            estimate = tokens_per_char * message_chars(payloads[record["row"]])
+            full_tokens += estimate
+            saved_tokens += max(0.0, estimate - record["prompt_eval_count"])
+        print(f"Prefix      : {prefix_tokens} shared tokens  |  ~{saved_tokens:.0f} of ~{full_tokens:.0f} "
+              f"prompt tokens reused from the KV cache instead of prefilled")
+    print(f"Metrics     : {metrics_path}")
+    return {"output": OUTPUT_PATH, "rows": n_done, "tokens": n_tokens, "elapsed": elapsed}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_name", type=str, required=True, help="Ollama model name")
+    parser.add_argument("--temperature", type=float, default=None,
+                        help="Override model file temperature (e.g. 0.0 for greedy, 1.0 for default)")
+    parser.add_argument("--max_new_tokens", type=int, default=None,
+                        help="Override max tokens to generate (Ollama: num_predict)")
+    add_run_args(parser)
+    args = parser.parse_args()
+    check_run_args(parser, args)
 
-            # Remove <think>...</think> parts and write a single-line TLDR to the result file
-            filtered_tldr = remove_think_content(generated_tldr)
-            filtered_tldr_single_line = " ".join(filtered_tldr.split())
-            f_out.write(filtered_tldr_single_line + "\n")
-            f_out.flush()
+    prompts = load_prompts(args.abstract_type)
+    endpoints = EndpointPool(args.ollama_urls)
+    try:
+        run_config(args, args.model_name, args.temperature, args.max_new_tokens, prompts, endpoints)
+    except FileExistsError as e:
+        parser.error(str(e))
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
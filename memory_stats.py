@@ -0,0 +1,20 @@
+import resource
+
+import torch
+
+def peak_memory_mb(device=None):
+    """Peak memory allocated by torch on a CUDA device since its last reset_peak_memory_stats.
+
+    Returns None on CPU: the only cheap figure there is the process's RSS
+    high-water mark (max_rss_mb), which never goes down, so it cannot measure
+    one stretch of work.
+    """
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    if not str(device).startswith("cuda"):
+        return None
+    return torch.cuda.max_memory_allocated(device) / 2**20
+
+def max_rss_mb():
+    # Lifetime high-water mark of this process's resident set (ru_maxrss is in KB on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
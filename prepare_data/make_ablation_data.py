@@ -2,14 +2,9 @@ import csv
 import random
 import argparse
 from tqdm import tqdm
-import nltk
-from nltk.tokenize import sent_tokenize
 
-nltk.download('punkt', quiet=True)
-
-def split_sentences(text):
-    sentences = sent_tokenize(text.strip())
-    return sentences
+# Run from the repo root: python -m prepare_data.make_ablation_data {sent_shuffle,tail} --input ...
+from sentence_segments import load_sentences
 
 def main(input_path, type_):
     assert type_ in {"sent_shuffle", "tail"}, "type must be one of 'sent_shuffle' or 'tail'"
@@ -28,9 +23,10 @@ def main(input_path, type_):
         writer.writeheader()
 
         rows = list(reader)
-        for row in tqdm(rows, desc="Processing"):
+        # Shared NLTK segmentation, so the ablations split exactly like the baselines
+        all_sentences = load_sentences(input_path, [row['abstract'] for row in rows], "nltk")
+        for row, sentences in tqdm(zip(rows, all_sentences), total=len(rows), desc="Processing"):
             abstract = row['abstract']
-            sentences = split_sentences(abstract)
             new_abstract = abstract  # Default assignment to avoid unbound error
             if type_ == "sent_shuffle":
                 random.shuffle(sentences)
@@ -0,0 +1,105 @@
+import os
+import argparse
+from multiprocessing import Pool
+import pandas as pd
+
+from cache_keys import content_keyed_path
+
+SEGMENTERS = ("nltk", "spacy")
+SPACY_MODEL = "en_core_web_sm"
+
+def segments_path(tsv_path, segmenter):
+    return content_keyed_path(os.path.join(os.path.dirname(tsv_path), "sentence_segments"),
+                              tsv_path, f"_{segmenter}.parquet", segmenter=segmenter)
+
+def nltk_spans(text):
+    # sent_tokenize returns substrings of text in order, so each one is found after the previous
+    from nltk.tokenize import sent_tokenize
+    starts, ends, cursor = [], [], 0
+    for sentence in sent_tokenize(text):
+        start = text.find(sentence, cursor)
+        starts.append(start)
+        ends.append(start + len(sentence))
+        cursor = start + len(sentence)
+    return starts, ends
+
+def spacy_spans(texts, workers):
+    import spacy
+    # NER and lemmas play no part in sentence boundaries (those come from the parser)
+    nlp = spacy.load(SPACY_MODEL, disable=["ner", "lemmatizer"])
+    spans = []
+    for doc in nlp.pipe(texts, n_process=workers or 1, batch_size=64):
+        assert doc.has_annotation("SENT_START")
+        spans.append(([s.start_char for s in doc.sents], [s.end_char for s in doc.sents]))
+    return spans
+
+def build_segments(tsv_path, segmenter, workers=None):
+    """Splits every abstract of tsv_path into sentences once and stores the offsets.
+
+    The table has one row per TSV row (columns: row, abs_doi, start, end) where
+    start/end are lists of character offsets into the abstract, so sentence i is
+    abstract[start[i]:end[i]]. It is written as parquet under sentence_segments/
+    next to the TSV.
+    """
+    df = pd.read_csv(tsv_path, sep="\t")
+    abstracts = df["abstract"].fillna("").astype(str).tolist()
+    if segmenter == "nltk":
+        import nltk
+        nltk.download('punkt', quiet=True)
+        with Pool(workers or os.cpu_count()) as pool:
+            spans = pool.map(nltk_spans, abstracts, chunksize=64)
+    elif segmenter == "spacy":
+        spans = spacy_spans(abstracts, workers)
+    else:
+        raise ValueError(f"Unknown segmenter {segmenter!r}, expected one of {SEGMENTERS}")
+    table = pd.DataFrame({
+        "row": range(len(df)),
+        "abs_doi": df["abs_doi"] if "abs_doi" in df else None,
+        "start": [starts for starts, _ in spans],
+        "end": [ends for _, ends in spans],
+    })
+    out_path = segments_path(tsv_path, segmenter)
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    table.to_parquet(out_path + ".tmp", index=False)
+    os.replace(out_path + ".tmp", out_path)
+    return table
+
+def load_segments(tsv_path, segmenter="nltk", workers=None):
+    """Loads the sentence offsets for tsv_path, building them first if they do not exist yet."""
+    path = segments_path(tsv_path, segmenter)
+    if os.path.exists(path):
+        return pd.read_parquet(path)
+    print(f"Segmenting {tsv_path} with {segmenter} ...")
+    return build_segments(tsv_path, segmenter, workers)
+
+def load_sentences(tsv_path, abstracts, segmenter="nltk", workers=None):
+    """Sentences of each abstract (the TSV's abstract column, in file order)."""
+    table = load_segments(tsv_path, segmenter, workers)
+    if len(table) != len(abstracts):
+        raise ValueError(f"{tsv_path} has {len(abstracts)} abstracts but its "
+                         f"{segmenter} segments have {len(table)} rows")
+    return [[abstract[s:e] for s, e in zip(starts, ends)]
+            for abstract, starts, ends in zip(abstracts, table["start"], table["end"])]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute sentence offsets shared by the ablation, baseline and tagging scripts")
+    parser.add_argument("tsv", type=str, nargs="*",
+                        help="TSV files to segment (default: the test set variants)")
+    parser.add_argument("--segmenters", nargs="+", default=["nltk"], choices=SEGMENTERS,
+                        help="Segmenters to run (default: nltk)")
+    parser.add_argument("--workers", type=int, default=None, help="Processes (default: all CPUs for nltk, 1 for spacy)")
+    args = parser.parse_args()
+
+    tsv_paths = args.tsv or [
+        f"data/paper_html_10.1038/abs_annotation/{name}.tsv"
+        for name in ("test", "test_sent_shuffle", "test_tail")
+    ]
+    for tsv_path in tsv_paths:
+        if not os.path.exists(tsv_path):
+            print(f"Skipping missing {tsv_path}")
+            continue
+        for segmenter in args.segmenters:
+            table = build_segments(tsv_path, segmenter, args.workers)
+            n_sentences = sum(len(starts) for starts in table["start"])
+            print(f"{tsv_path} [{segmenter}]: {len(table)} abstracts, {n_sentences} sentences "
+                  f"-> {segments_path(tsv_path, segmenter)}")
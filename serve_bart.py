@@ -0,0 +1,263 @@
+"""
+Long-lived local summarisation service around the fine-tuned BART checkpoint.
+
+The tokenizer and model are loaded once. Concurrent requests are coalesced into
+micro-batches: the batcher takes every request that queued up while the previous
+batch ran, then waits up to --max_wait_ms from that point for more, dispatching
+early once the batch holds --max_batch requests.
+
+Endpoints (Ollama-like, so gen_llm_sum.py-style clients can target it):
+    POST /api/generate  {"model": ..., "prompt": "<abstract>", "stream": false,
+                         "options": {"num_predict": 128}}
+                        -> {"model", "response", "done": true, "eval_count", "total_duration", ...}
+    GET  /api/tags      model list
+    GET  /api/stats     queue depth, batch sizes and latency percentiles
+
+Prompts in the gen_llm_sum.py format ("[Abstract] ...[Word count: N]") are
+reduced to the bare abstract, which is what BART was fine-tuned on.
+
+Launch:
+    python serve_bart.py --port 9904 [--checkpoint data/BART/checkpoints/best_model]
+"""
+
+import argparse
+import json
+import os
+import queue
+import re
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import torch
+
+from gen_bart_sum import (
+    BACKENDS, CHECKPOINT_DIR, CPU_BACKENDS, MAX_NEW_TOKENS, generate_batch, load_model,
+)
+
+PROMPT_RE = re.compile(r"^\s*\[Abstract\]\s*(.*?)\s*(\[Word count:\s*\d+\])?\s*$", re.DOTALL)
+LATENCY_WINDOW = 1000   # recent requests kept for the latency percentiles
+LISTEN_BACKLOG = 128    # pending connections the socket accepts (the default of 5 resets bursts)
+
+
+def strip_prompt(prompt: str) -> str:
+    match = PROMPT_RE.match(prompt)
+    return match.group(1) if match else prompt
+
+
+class BacklogHTTPServer(ThreadingHTTPServer):
+    request_queue_size = LISTEN_BACKLOG
+
+
+class Request:
+    def __init__(self, abstract: str, max_new_tokens: int):
+        self.abstract = abstract
+        self.max_new_tokens = max_new_tokens
+        self.enqueued = time.perf_counter()
+        self.done = threading.Event()
+        self.response = None
+        self.eval_count = 0
+        self.error = None
+
+
+class MicroBatcher:
+    """Collects queued requests into batches and runs them on one model."""
+
+    def __init__(self, model, tokenizer, device: str, max_batch: int, max_wait_ms: float):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.waits = deque(maxlen=LATENCY_WINDOW)
+        self.batch_sizes = deque(maxlen=LATENCY_WINDOW)
+        self.served = 0
+        self.in_flight = 0
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def submit(self, abstract: str, max_new_tokens: int) -> Request:
+        request = Request(abstract, max_new_tokens)
+        self.queue.put(request)
+        return request
+
+    def _collect(self) -> list:
+        batch = [self.queue.get()]
+        # Requests that queued up while the previous batch ran join without waiting
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        # A backlog has already waited, so the wait for stragglers starts now
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            started = time.perf_counter()
+            with self.lock:
+                self.in_flight = len(batch)
+            # Requests asking for different lengths are generated separately
+            groups = {}
+            for request in batch:
+                groups.setdefault(request.max_new_tokens, []).append(request)
+            for max_new_tokens, requests in groups.items():
+                try:
+                    # The fast tokenizer is not thread-safe, so only this thread uses it
+                    texts, counts = generate_batch(self.model, self.tokenizer,
+                                                   [r.abstract for r in requests], self.device,
+                                                   max_new_tokens=max_new_tokens,
+                                                   return_token_counts=True)
+                except Exception as e:
+                    for request in requests:
+                        request.error = str(e)
+                        request.done.set()
+                    continue
+                for request, text, count in zip(requests, texts, counts):
+                    request.response = text
+                    request.eval_count = count
+                    request.done.set()
+            finished = time.perf_counter()
+            with self.lock:
+                self.in_flight = 0
+                self.served += len(batch)
+                self.batch_sizes.append(len(batch))
+                for request in batch:
+                    self.waits.append(started - request.enqueued)
+                    self.latencies.append(finished - request.enqueued)
+
+    def stats(self) -> dict:
+        def percentiles(values):
+            values = sorted(values)
+            if not values:
+                return {}
+            pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+            return {"p50": pick(0.50), "p90": pick(0.90), "p99": pick(0.99), "max": values[-1]}
+
+        with self.lock:
+            return {
+                "queue_depth": self.queue.qsize(),
+                "in_flight": self.in_flight,
+                "served": self.served,
+                "mean_batch_size": (sum(self.batch_sizes) / len(self.batch_sizes)
+                                    if self.batch_sizes else 0.0),
+                "latency_s": percentiles(self.latencies),
+                "queue_wait_s": percentiles(self.waits),
+            }
+
+
+def make_handler(batcher: MicroBatcher, model_name: str):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, status: int, body: dict, content_type="application/json"):
+            data = (json.dumps(body) + ("\n" if content_type == "application/x-ndjson" else "")).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/api/stats":
+                self._send_json(200, batcher.stats())
+            elif self.path == "/api/tags":
+                self._send_json(200, {"models": [{"name": model_name, "model": model_name}]})
+            else:
+                self._send_json(404, {"error": f"unknown path {self.path}"})
+
+        def do_POST(self):
+            try:
+                self._generate()
+            except Exception as e:
+                # Report the failure rather than dropping the client's connection
+                self._send_json(500, {"error": f"{type(e).__name__}: {e}"})
+
+        def _generate(self):
+            if self.path != "/api/generate":
+                self._send_json(404, {"error": f"unknown path {self.path}"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                payload = json.loads(self.rfile.read(length))
+                prompt = payload["prompt"]
+            except (ValueError, KeyError) as e:
+                self._send_json(400, {"error": f"bad request: {e}"})
+                return
+            options = payload.get("options") or {}
+            max_new_tokens = int(options.get("num_predict") or MAX_NEW_TOKENS)
+
+            request = batcher.submit(strip_prompt(prompt), max_new_tokens)
+            request.done.wait()
+            if request.error is not None:
+                self._send_json(500, {"error": request.error})
+                return
+            total = time.perf_counter() - request.enqueued
+            body = {
+                "model": payload.get("model", model_name),
+                "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+                "response": request.response,
+                "done": True,
+                "done_reason": "stop",
+                "eval_count": request.eval_count,
+                "total_duration": int(total * 1e9),
+            }
+            # A streaming client gets the whole answer as a single final NDJSON chunk
+            content_type = "application/x-ndjson" if payload.get("stream") else "application/json"
+            self._send_json(200, body, content_type)
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the fine-tuned BART model over HTTP")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_DIR,
+                        help="Path to fine-tuned BART checkpoint directory")
+    parser.add_argument("--model_name", default="bart",
+                        help="Model name reported by the API (default: bart)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9904)
+    parser.add_argument("--device", default="cuda:0" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--backend", default="torch", choices=BACKENDS,
+                        help="Inference backend, as in gen_bart_sum.py")
+    parser.add_argument("--max_batch", type=int, default=32,
+                        help="Most requests coalesced into one generate call (default: 32)")
+    parser.add_argument("--max_wait_ms", type=float, default=20,
+                        help="After draining the queue, how long to wait for more requests "
+                             "to join the batch (default: 20)")
+    args = parser.parse_args()
+
+    device = "cpu" if args.backend in CPU_BACKENDS else args.device
+    ckpt = os.path.abspath(args.checkpoint)
+    tokenizer, model = load_model(ckpt, device, args.backend)
+    batcher = MicroBatcher(model, tokenizer, device, args.max_batch, args.max_wait_ms)
+
+    server = BacklogHTTPServer((args.host, args.port), make_handler(batcher, args.model_name))
+    print(f"Serving {ckpt} ({args.backend} on {device}) at http://{args.host}:{args.port}  |  "
+          f"max_batch={args.max_batch}, max_wait={args.max_wait_ms}ms")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
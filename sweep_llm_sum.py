@@ -0,0 +1,85 @@
+"""
+Sweep gen_llm_sum.py over a grid of models × temperatures × num_predict values.
+
+The test set is read once and the grid is ordered model-major: every
+temperature/num_predict point for one model runs while that model is resident
+on the Ollama server(s), and the model is unloaded before the next one is
+loaded. Each point writes the same tem{t}_max{n}_{model}.txt file (plus journal
+and metrics) as a single gen_llm_sum.py invocation, so interrupted sweeps
+resume where they stopped.
+
+Example:
+    python sweep_llm_sum.py --models gemma4 qwen3.6 --temperatures 0.0 0.5 1.0 \
+        --max_new_tokens 128 --concurrency 8
+"""
+
+import argparse
+import itertools
+import time
+
+import requests
+
+from gen_llm_sum import (
+    EndpointPool, add_run_args, check_run_args, load_prompts,
+    ollama_model_for, run_config,
+)
+
+
+def unload_model(endpoints, ollama_model):
+    # keep_alive=0 asks Ollama to free the model right away instead of after its timeout
+    for url in endpoints.urls:
+        try:
+            requests.post(url, json={"model": ollama_model, "keep_alive": 0}, timeout=60)
+        except requests.RequestException as e:
+            print(f"Unloading {ollama_model} on {url} failed ({e})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run gen_llm_sum.py over a parameter grid")
+    parser.add_argument("--models", type=str, nargs="+", required=True,
+                        help="Ollama model names, e.g. gemma4 qwen3.6 deepseek_r1 llama4 gpt_oss")
+    parser.add_argument("--temperatures", type=float, nargs="+", default=None,
+                        help="Temperatures to sweep (default: keep the Modelfile temperature)")
+    parser.add_argument("--max_new_tokens", type=int, nargs="+", default=None,
+                        help="num_predict values to sweep (default: keep the Modelfile setting)")
+    parser.add_argument("--keep_loaded", action="store_true",
+                        help="Do not unload each model once its grid points are done")
+    add_run_args(parser)
+    args = parser.parse_args()
+    check_run_args(parser, args)
+
+    temperatures = args.temperatures or [None]
+    max_new_tokens = args.max_new_tokens or [None]
+    grid = [(model_name, t, n) for model_name in args.models
+            for t, n in itertools.product(temperatures, max_new_tokens)]
+    print(f"Grid        : {len(args.models)} models × {len(temperatures)} temperatures × "
+          f"{len(max_new_tokens)} num_predict = {len(grid)} runs")
+
+    prompts = load_prompts(args.abstract_type)
+    endpoints = EndpointPool(args.ollama_urls)
+
+    summaries = []
+    sweep_start = time.perf_counter()
+    for model_name, points in itertools.groupby(grid, key=lambda point: point[0]):
+        for _, temperature, n_predict in points:
+            print("=" * 60)
+            print(f"Model: {model_name}  |  temperature: {temperature}  |  num_predict: {n_predict}")
+            try:
+                summary = run_config(args, model_name, temperature, n_predict, prompts, endpoints)
+            except FileExistsError as e:
+                print(f"Skipped: {e}")
+                continue
+            summaries.append((model_name, temperature, n_predict, summary))
+        if not args.keep_loaded:
+            unload_model(endpoints, ollama_model_for(args, model_name))
+
+    print("=" * 60)
+    for model_name, temperature, n_predict, summary in summaries:
+        rate = summary["rows"] / max(summary["elapsed"], 1e-9)
+        print(f"{model_name:<12} tem={temperature}  max={n_predict}  "
+              f"{summary['rows']:>6} rows  {rate:8.2f} req/s  -> {summary['output']}")
+    print(f"Sweep wall time: {time.perf_counter() - sweep_start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -7,19 +7,30 @@ Launch (4 GPUs):
 
 Single GPU (for quick sanity check):
     python3 train_bart.py [options]
+
+Tokenise train.tsv into the Arrow cache ahead of time (otherwise done on first launch):
+    python3 train_bart.py --prepare_only [--preprocessing_workers 8]
 """
 
 import csv
 import os
+import json
+import math
+import time
+import shutil
 import argparse
 
 # Suppress tokenizer parallelism warning when DataLoader forks workers
 os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
 
 import numpy as np
+import torch
 import evaluate
-from datasets import Dataset
+from torch.utils.data import DataLoader
+from datasets import Dataset, load_from_disk
+from accelerate import PartialState
 import transformers
+from transformers.trainer_pt_utils import get_length_grouped_indices
 from transformers import (
     AutoTokenizer,
     AutoModelForSeq2SeqLM,
@@ -27,15 +38,21 @@ from transformers import (
     Seq2SeqTrainer,
     Seq2SeqTrainingArguments,
     EarlyStoppingCallback,
+    TrainerCallback,
 )
 
+from cache_keys import content_keyed_path
+from memory_stats import max_rss_mb, peak_memory_mb
+
 # ── Defaults ───────────────────────────────────────────────────────────────────
 TRAIN_FILE  = "data/paper_html_10.1038/abs_annotation/train.tsv"
 OUTPUT_DIR  = "data/BART/checkpoints"
 LOG_DIR     = "data/BART/logs"
+CACHE_DIR   = "data/BART/token_cache"
 MODEL_NAME  = "facebook/bart-large-cnn"   # CNN/DM checkpoint: good init for summarization
 MAX_INPUT   = 1024   # BART maximum supported length
 MAX_TARGET  = 128    # annotations are short (~20-60 words)
+CACHE_VERSION = 2    # bump when the cached columns change
 
 
 # ── Data loading ───────────────────────────────────────────────────────────────
@@ -46,6 +63,347 @@ def load_tsv(filepath: str) -> list[dict]:
                 for row in reader]
 
 
+def token_cache_path(cache_dir: str, train_file: str, tokenizer_name: str) -> str:
+    return content_keyed_path(cache_dir, train_file,
+                              version=CACHE_VERSION, tokenizer=tokenizer_name,
+                              max_input=MAX_INPUT, max_target=MAX_TARGET)
+
+
+def build_token_cache(train_file: str, tokenizer, cache_path: str, num_proc: int) -> Dataset:
+    """Tokenises every row of train_file once and saves it as an Arrow dataset.
+
+    Rows keep the TSV order; shuffling and the validation split happen after
+    loading, so one cache serves every seed and --val_split.
+    """
+    def preprocess(batch):
+        model_inputs = tokenizer(
+            batch["abstract"],
+            max_length=MAX_INPUT,
+            truncation=True,
+            padding=False,
+        )
+        labels = tokenizer(
+            text_target=batch["annotation"],
+            max_length=MAX_TARGET,
+            truncation=True,
+            padding=False,
+        )
+        model_inputs["labels"] = labels["input_ids"]
+        # Lengths for the length-grouped samplers (dropped before batches reach the model)
+        model_inputs["length"] = [len(ids) for ids in model_inputs["input_ids"]]
+        model_inputs["label_length"] = [len(ids) for ids in labels["input_ids"]]
+        return model_inputs
+
+    dataset = Dataset.from_list(load_tsv(train_file)).map(
+        preprocess, batched=True, remove_columns=["abstract", "annotation"],
+        num_proc=num_proc if num_proc > 1 else None, desc="Tokenising"
+    )
+    # Save under a temporary name first, so an interrupted run never leaves a partial cache
+    tmp_path = cache_path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    dataset.save_to_disk(tmp_path)
+    os.replace(tmp_path, cache_path)
+    return load_from_disk(cache_path)
+
+
+def load_token_cache(train_file: str, tokenizer, tokenizer_name: str,
+                     cache_dir: str, num_proc: int = 1) -> Dataset:
+    """Memory-maps the tokenised train_file, building the cache on first use.
+
+    Under torchrun the local main process builds the cache while the other ranks
+    wait, then every rank maps the same Arrow files.
+    """
+    cache_path = token_cache_path(cache_dir, train_file, tokenizer_name)
+    with PartialState().local_main_process_first():
+        if os.path.isdir(cache_path):
+            return load_from_disk(cache_path)
+        os.makedirs(cache_dir, exist_ok=True)
+        print(f"Building token cache {cache_path} ...")
+        return build_token_cache(train_file, tokenizer, cache_path, num_proc)
+
+
+# ── Length-aware batching ──────────────────────────────────────────────────────
+def padded_length(n: int) -> int:
+    # DataCollatorForSeq2Seq pads inputs and labels to a multiple of 8
+    return -(-n // 8) * 8
+
+
+def padding_ratio(batches: list, lengths: list, label_lengths: list) -> float:
+    """Fraction of the collated input + label tokens that are padding."""
+    real = padded = 0
+    for batch in batches:
+        real   += sum(lengths[i] + label_lengths[i] for i in batch)
+        padded += len(batch) * (padded_length(max(lengths[i] for i in batch))
+                                + padded_length(max(label_lengths[i] for i in batch)))
+    return 1 - real / max(padded, 1)
+
+
+class TokenBudgetBatchSampler:
+    """Batches of similar-length rows holding at most max_tokens padded tokens each.
+
+    Batches are packed once from the length-sorted rows and only their order is
+    shuffled per epoch, so every epoch has the same number of steps and the LR
+    schedule is exact. The batch count is rounded up to a multiple of num_replicas
+    by repeating batches; under DDP accelerate hands every num_replicas-th batch
+    to each rank, so all ranks take the same number of steps.
+    """
+
+    def __init__(self, lengths: list, label_lengths: list, max_tokens: int,
+                 num_replicas: int = 1, seed: int = 0):
+        order = sorted(range(len(lengths)), key=lambda i: (lengths[i], label_lengths[i]), reverse=True)
+        self.batches = []
+        batch, max_input, max_label = [], 0, 0
+        for i in order:
+            new_input = max(max_input, lengths[i])
+            new_label = max(max_label, label_lengths[i])
+            if batch and (len(batch) + 1) * (padded_length(new_input) + padded_length(new_label)) > max_tokens:
+                self.batches.append(batch)
+                batch, new_input, new_label = [], lengths[i], label_lengths[i]
+            batch.append(i)
+            max_input, max_label = new_input, new_label
+        if batch:
+            self.batches.append(batch)
+        self.batches += self.batches[: -len(self.batches) % num_replicas]
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        # Under DDP set_epoch does not reach this sampler, so the epoch also
+        # advances per pass; every rank iterates equally often and stays in step
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        self.epoch += 1
+        for j in torch.randperm(len(self.batches), generator=generator).tolist():
+            yield self.batches[j]
+
+
+# ── Throughput instrumentation ─────────────────────────────────────────────────
+class ThroughputCallback(TrainerCallback):
+    """Per-device throughput, step-time breakdown and peak memory.
+
+    Each training log step writes perf/* scalars to log_dir: rows/s, real and
+    padded tokens/s, and seconds per optimizer step spent in data loading,
+    forward + backward and the optimizer. On GPU the peak allocated memory of
+    each logging window is recorded; on CPU only the process's lifetime RSS
+    high-water mark exists, logged as perf/max_rss_mb. At the end a summary is
+    written to <output_dir>/throughput_summary.json. Data loading time and
+    batch sizes come from BartTrainer.get_batch_samples.
+
+    With profile_steps=(start, n), torch.profiler records optimizer steps
+    start..start+n-1 to <log_dir>/profile (viewable in tensorboard).
+    """
+
+    PHASES = ("data", "forward_backward", "optimizer", "step")
+
+    def __init__(self, log_dir: str, output_dir: str, profile_steps=None):
+        self.log_dir = log_dir
+        self.output_dir = output_dir
+        self.profile_steps = profile_steps
+        self.writer = None
+        self.profiler = None
+        self.window = self._empty()
+        self.total = self._empty()
+        self.marks = {}
+
+    @staticmethod
+    def _empty() -> dict:
+        return {"steps": 0, "rows": 0, "tokens": 0, "padded_tokens": 0,
+                **{phase: 0.0 for phase in ThroughputCallback.PHASES}}
+
+    def _now(self) -> float:
+        # Kernels run asynchronously; synchronise so the time lands in the right phase
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _add(self, key: str, value):
+        self.window[key] += value
+        self.total[key] += value
+
+    def observe_batches(self, batches: list, seconds: float):
+        """Called by the trainer with the micro-batches of one optimizer step."""
+        self._add("data", seconds)
+        for batch in batches:
+            self._add("rows", batch["input_ids"].shape[0])
+            self._add("padded_tokens", batch["input_ids"].numel())
+            self._add("tokens", int(batch["attention_mask"].sum()))
+
+    def on_train_begin(self, args, state, control, **kwargs):
+        if state.is_world_process_zero:
+            from torch.utils.tensorboard import SummaryWriter
+            self.writer = SummaryWriter(log_dir=self.log_dir)
+        if self.profile_steps:
+            start, active = self.profile_steps
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            # Optimizer step START is profiler step START-1 (0-based); warm up on the step before it if any
+            warmup = 1 if start >= 2 else 0
+            self.profiler = torch.profiler.profile(
+                activities=activities,
+                schedule=torch.profiler.schedule(skip_first=max(start - 1 - warmup, 0), wait=0,
+                                                 warmup=warmup, active=active, repeat=1),
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(
+                    os.path.join(self.log_dir, "profile"), worker_name=f"rank{args.process_index}"),
+                record_shapes=True,
+                profile_memory=True,
+            )
+            self.profiler.start()
+        self.marks["train_begin"] = time.perf_counter()
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+
+    def on_step_begin(self, args, state, control, **kwargs):
+        self.marks["step_begin"] = self._now()
+
+    def on_pre_optimizer_step(self, args, state, control, **kwargs):
+        self.marks["pre_optimizer"] = self._now()
+
+    def on_optimizer_step(self, args, state, control, **kwargs):
+        now = self._now()
+        self._add("forward_backward", self.marks["pre_optimizer"] - self.marks["step_begin"])
+        self._add("optimizer", now - self.marks["pre_optimizer"])
+
+    def on_step_end(self, args, state, control, **kwargs):
+        self._add("step", self._now() - self.marks["step_begin"])
+        self._add("steps", 1)
+        if self.profiler is not None:
+            self.profiler.step()
+
+    def _rates(self, stats: dict) -> dict:
+        seconds = max(stats["data"] + stats["step"], 1e-9)
+        steps = max(stats["steps"], 1)
+        return {
+            "rows_per_s":           stats["rows"] / seconds,
+            "tokens_per_s":         stats["tokens"] / seconds,
+            "padded_tokens_per_s":  stats["padded_tokens"] / seconds,
+            **{f"{phase}_s_per_step": stats[phase] / steps for phase in self.PHASES},
+        }
+
+    def on_log(self, args, state, control, logs=None, **kwargs):
+        if not logs or "loss" not in logs or self.window["steps"] == 0:
+            return
+        if self.writer is not None:
+            for name, value in self._rates(self.window).items():
+                self.writer.add_scalar(f"perf/{name}", value, state.global_step)
+            if torch.cuda.is_available():
+                self.writer.add_scalar("perf/peak_memory_mb", peak_memory_mb(), state.global_step)
+            else:
+                self.writer.add_scalar("perf/max_rss_mb", max_rss_mb(), state.global_step)
+            self.writer.add_scalar("perf/num_input_tokens_seen", state.num_input_tokens_seen,
+                                   state.global_step)
+        self.window = self._empty()
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+
+    def on_train_end(self, args, state, control, **kwargs):
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
+        if self.writer is None:
+            return
+        self.writer.close()
+        self.writer = None
+        summary = {
+            "world_size":           args.world_size,
+            "optimizer_steps":      self.total["steps"],
+            "rows":                 self.total["rows"],
+            "tokens":               self.total["tokens"],
+            "padded_tokens":        self.total["padded_tokens"],
+            "wall_time_s":          time.perf_counter() - self.marks["train_begin"],
+            "num_input_tokens_seen": state.num_input_tokens_seen,
+            "dataloader_num_workers": args.dataloader_num_workers,
+            "gradient_accumulation_steps": args.gradient_accumulation_steps,
+            **self._rates(self.total),
+        }
+        if torch.cuda.is_available():
+            summary["last_peak_memory_mb"] = peak_memory_mb()
+        else:
+            summary["max_rss_mb"] = max_rss_mb()
+        path = os.path.join(self.output_dir, "throughput_summary.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+        print(f"Throughput (rank 0): {summary['rows_per_s']:.2f} rows/s, "
+              f"{summary['tokens_per_s']:.0f} tokens/s, data {summary['data_s_per_step']:.3f}s + "
+              f"fwd/bwd {summary['forward_backward_s_per_step']:.3f}s + "
+              f"optimizer {summary['optimizer_s_per_step']:.3f}s per step  ->  {path}")
+
+
+class BartTrainer(Seq2SeqTrainer):
+    """Seq2SeqTrainer with a few additions.
+
+    It can draw training batches from a batch sampler. In loss-only evaluation
+    mode it also scores generations on a small fixed sample: every rouge_every
+    epochs and whenever sampled_rouge() is called. It also reports data-loading
+    time and batch sizes to an optional ThroughputCallback.
+    """
+
+    def __init__(self, *args, train_batch_sampler=None, rouge_dataset=None,
+                 rouge_metrics=None, rouge_every: int = 0, throughput=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.train_batch_sampler = train_batch_sampler
+        self.rouge_dataset = rouge_dataset
+        self.rouge_metrics = rouge_metrics
+        self.rouge_every = rouge_every
+        self.throughput = throughput
+        if throughput is not None:
+            self.add_callback(throughput)
+
+    def get_batch_samples(self, epoch_iterator, num_batches, device):
+        start = time.perf_counter()
+        batch_samples, num_items_in_batch = super().get_batch_samples(epoch_iterator, num_batches, device)
+        if self.throughput is not None:
+            self.throughput.observe_batches(batch_samples, time.perf_counter() - start)
+        return batch_samples, num_items_in_batch
+
+    def evaluate(self, eval_dataset=None, ignore_keys=None, metric_key_prefix="eval", **gen_kwargs):
+        metrics = super().evaluate(eval_dataset, ignore_keys, metric_key_prefix, **gen_kwargs)
+        epoch = round(self.state.epoch or 0)
+        if (self.rouge_dataset is not None and self.rouge_every > 0
+                and metric_key_prefix == "eval" and epoch > 0 and epoch % self.rouge_every == 0):
+            metrics.update(self.sampled_rouge())
+        return metrics
+
+    def sampled_rouge(self) -> dict:
+        """Generates for the ROUGE sample and logs its metrics as eval_sample_*."""
+        compute_metrics = self.compute_metrics
+        self.compute_metrics = self.rouge_metrics
+        self.args.predict_with_generate = True
+        try:
+            output = self.predict(self.rouge_dataset, metric_key_prefix="eval_sample")
+        finally:
+            self.args.predict_with_generate = False
+            self.compute_metrics = compute_metrics
+        self.log(output.metrics)
+        return output.metrics
+
+    def get_train_dataloader(self) -> DataLoader:
+        if self.train_batch_sampler is None:
+            return super().get_train_dataloader()
+        dataset = self._remove_unused_columns(self.train_dataset, description="Training")
+        dataloader = DataLoader(
+            dataset,
+            batch_sampler=self.train_batch_sampler,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+            persistent_workers=self.args.dataloader_persistent_workers,
+        )
+        # Batch sizes vary, so accelerate must not try to even them out across ranks
+        even_batches = self.accelerator.even_batches
+        self.accelerator.even_batches = False
+        try:
+            return self.accelerator.prepare(dataloader)
+        finally:
+            self.accelerator.even_batches = even_batches
+
+
 # ── Main ───────────────────────────────────────────────────────────────────────
 def main():
     parser = argparse.ArgumentParser(description="Fine-tune BART for bibliography annotation")
@@ -63,21 +421,60 @@ def main():
     parser.add_argument("--early_stopping_patience", type=int, default=0,
                         help="0 = disabled; N>0 = stop after N epochs without improvement")
     parser.add_argument("--seed",                  type=int,   default=42)
+    parser.add_argument("--cache_dir",             default=CACHE_DIR,
+                        help="Directory of pre-tokenised Arrow datasets (one per tokenizer/TSV)")
+    parser.add_argument("--preprocessing_workers", type=int,   default=1,
+                        help="Processes used when the token cache has to be built")
+    parser.add_argument("--group_by_length",       action="store_true",
+                        help="Draw batches of similar-length abstracts (less padding per step)")
+    parser.add_argument("--max_tokens_per_batch",  type=int,   default=0,
+                        help="0 = fixed --per_device_batch_size; N>0 = length-sorted batches of at "
+                             "most N padded input + label tokens per device")
+    parser.add_argument("--eval_mode",             default="generate", choices=["generate", "loss"],
+                        help="generate = generation + ROUGE on the whole val split every epoch; "
+                             "loss = eval loss every epoch, ROUGE on a fixed sample only (see below)")
+    parser.add_argument("--rouge_samples",         type=int,   default=256,
+                        help="--eval_mode loss: val rows generated for the sampled ROUGE")
+    parser.add_argument("--rouge_every",           type=int,   default=0,
+                        help="--eval_mode loss: sampled ROUGE every K epochs (0 = only after training)")
+    parser.add_argument("--throughput_stats",      action="store_true",
+                        help="Log rows/tokens per second, step-time breakdown and peak memory "
+                             "to tensorboard (perf/*) and <output_dir>/throughput_summary.json")
+    parser.add_argument("--profile_steps",         type=int,   nargs=2, default=None,
+                        metavar=("START", "N"),
+                        help="With --throughput_stats: torch.profiler trace of N optimizer steps "
+                             "from step START, written to <log_dir>/profile")
+    parser.add_argument("--prepare_only",          action="store_true",
+                        help="Build the token cache for --train_file and exit")
     args = parser.parse_args()
 
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name)
+    if args.prepare_only:
+        dataset = load_token_cache(args.train_file, tokenizer, args.model_name,
+                                   args.cache_dir, args.preprocessing_workers)
+        print(f"Token cache ready: {len(dataset)} rows in "
+              f"{token_cache_path(args.cache_dir, args.train_file, args.model_name)}")
+        return
+
     os.makedirs(args.output_dir, exist_ok=True)
     os.makedirs(args.log_dir,    exist_ok=True)
 
-    # ── Load & split data ──────────────────────────────────────────────────────
-    records = load_tsv(args.train_file)
-    dataset = Dataset.from_list(records).shuffle(seed=args.seed)
-    splits   = dataset.train_test_split(test_size=args.val_split, seed=args.seed)
-    train_ds, val_ds = splits["train"], splits["test"]
+    # ── Load & split data (pre-tokenised, memory-mapped) ───────────────────────
+    # Shuffle/split only build index mappings; keep_in_memory stops every rank
+    # from writing its own indices file next to the shared cache. The split is
+    # the one train_test_split(seed=...) makes, done by hand because that method
+    # always writes indices files for datasets loaded from disk.
+    dataset = load_token_cache(args.train_file, tokenizer, args.model_name,
+                               args.cache_dir, args.preprocessing_workers)
+    dataset = dataset.shuffle(seed=args.seed, keep_in_memory=True)
+    permutation = np.random.default_rng(args.seed).permutation(len(dataset))
+    n_val    = math.ceil(args.val_split * len(dataset))
+    train_ds = dataset.select(permutation[n_val:], keep_in_memory=True)
+    val_ds   = dataset.select(permutation[:n_val], keep_in_memory=True)
 
     print(f"Train size: {len(train_ds)}, Val size: {len(val_ds)}")
 
-    # ── Tokenizer & model ──────────────────────────────────────────────────────
-    tokenizer = AutoTokenizer.from_pretrained(args.model_name)
+    # ── Model ──────────────────────────────────────────────────────────────────
     model     = AutoModelForSeq2SeqLM.from_pretrained(args.model_name)
 
     # bart-large-cnn's GenerationConfig was tuned for long CNN/DM summaries.
@@ -87,31 +484,6 @@ def main():
     model.generation_config.min_length = 0
     model.generation_config.no_repeat_ngram_size = 0
 
-    def preprocess(batch):
-        model_inputs = tokenizer(
-            batch["abstract"],
-            max_length=MAX_INPUT,
-            truncation=True,
-            padding=False,
-        )
-        labels = tokenizer(
-            text_target=batch["annotation"],
-            max_length=MAX_TARGET,
-            truncation=True,
-            padding=False,
-        )
-        model_inputs["labels"] = labels["input_ids"]
-        return model_inputs
-
-    train_ds = train_ds.map(
-        preprocess, batched=True, remove_columns=["abstract", "annotation"],
-        desc="Tokenising train"
-    )
-    val_ds = val_ds.map(
-        preprocess, batched=True, remove_columns=["abstract", "annotation"],
-        desc="Tokenising val"
-    )
-
     data_collator = DataCollatorForSeq2Seq(
         tokenizer, model=model, label_pad_token_id=-100, pad_to_multiple_of=8
     )
@@ -149,10 +521,10 @@ def main():
         label_smoothing_factor=0.1,  # regularise against overconfidence on small dataset
 
         # ---- precision ----
-        bf16=True,           # L40 has native BF16 support (Ada Lovelace)
+        bf16=torch.cuda.is_available(),   # L40 has native BF16 support (Ada Lovelace); fp32 on CPU
 
         # ---- generation (for eval) ----
-        predict_with_generate=True,
+        predict_with_generate=args.eval_mode == "generate",
         generation_max_length=MAX_TARGET,
 
         # ---- checkpointing & logging ----
@@ -165,24 +537,59 @@ def main():
         metric_for_best_model="eval_loss",
         greater_is_better=False,
 
+        # ---- batching ----
+        group_by_length=args.group_by_length,
+        length_column_name="length",
+
         # ---- misc ----
         seed=args.seed,
         log_level="info",
+        include_num_input_tokens_seen=args.throughput_stats,
         report_to="tensorboard",
         logging_dir=args.log_dir,
         ddp_find_unused_parameters=False,
         dataloader_num_workers=4,
     )
 
+    # ── Batching & padding report ──────────────────────────────────────────────
+    lengths, label_lengths = train_ds["length"], train_ds["label_length"]
+    batch_size = args.per_device_batch_size
+    generator  = torch.Generator()
+    generator.manual_seed(args.seed)
+    random_order  = torch.randperm(len(train_ds), generator=generator).tolist()
+    grouped_order = get_length_grouped_indices(lengths, batch_size * args.grad_accum, generator=generator)
+    report = {
+        "random":  [random_order[i : i + batch_size] for i in range(0, len(random_order), batch_size)],
+        "grouped": [grouped_order[i : i + batch_size] for i in range(0, len(grouped_order), batch_size)],
+    }
+    train_batch_sampler = None
+    if args.max_tokens_per_batch > 0:
+        train_batch_sampler = TokenBudgetBatchSampler(
+            lengths, label_lengths, args.max_tokens_per_batch,
+            num_replicas=training_args.world_size, seed=args.seed,
+        )
+        report["token_budget"] = train_batch_sampler.batches
+    if training_args.process_index == 0:
+        for name, batches in report.items():
+            print(f"Padding ({name:<12}): {padding_ratio(batches, lengths, label_lengths):6.1%} of tokens"
+                  f"  |  {len(batches)} batches, {len(train_ds) / len(batches):.1f} rows/batch")
+
     # ── Trainer ────────────────────────────────────────────────────────────────
-    trainer = Seq2SeqTrainer(
+    trainer = BartTrainer(
         model=model,
         args=training_args,
         train_dataset=train_ds,
         eval_dataset=val_ds,
         processing_class=tokenizer,
         data_collator=data_collator,
-        compute_metrics=compute_metrics,
+        compute_metrics=compute_metrics if args.eval_mode == "generate" else None,
+        train_batch_sampler=train_batch_sampler,
+        rouge_dataset=(val_ds.select(range(min(args.rouge_samples, len(val_ds))), keep_in_memory=True)
+                       if args.eval_mode == "loss" else None),
+        rouge_metrics=compute_metrics,
+        rouge_every=args.rouge_every,
+        throughput=(ThroughputCallback(args.log_dir, args.output_dir, args.profile_steps)
+                    if args.throughput_stats else None),
         callbacks=(
             [EarlyStoppingCallback(early_stopping_patience=args.early_stopping_patience)]
             if args.early_stopping_patience > 0 else []
@@ -191,13 +598,26 @@ def main():
 
     print("=" * 60)
     print(f"Model:           {args.model_name}")
-    print(f"Effective batch: {args.per_device_batch_size * args.grad_accum} × num_gpus")
+    if train_batch_sampler is not None:
+        print(f"Effective batch: ≤{args.max_tokens_per_batch} tokens × {args.grad_accum} × num_gpus")
+    else:
+        print(f"Effective batch: {args.per_device_batch_size * args.grad_accum} × num_gpus")
     print(f"Epochs:          {args.num_epochs}  (early stopping patience={args.early_stopping_patience})")
+    if args.eval_mode == "loss":
+        print(f"Evaluation:      loss every epoch, ROUGE on {args.rouge_samples} val rows "
+              + (f"every {args.rouge_every} epochs" if args.rouge_every > 0 else "after training"))
     print(f"Checkpoints:     {args.output_dir}")
     print("=" * 60)
 
     trainer.train()
 
+    if args.eval_mode == "loss":
+        # ROUGE of the model that is saved below (the best one by eval_loss)
+        metrics = trainer.sampled_rouge()
+        if training_args.process_index == 0:
+            print("Sampled ROUGE: " + ", ".join(
+                f"{k.removeprefix('eval_sample_')}={v}" for k, v in metrics.items() if "rouge" in k))
+
     # Save best model
     best_dir = os.path.join(args.output_dir, "best_model")
     trainer.save_model(best_dir)
@@ -1,13 +1,77 @@
+import os
+import argparse
+from multiprocessing import Pool
+import pandas as pd
 import nltk
 from nltk.tokenize import word_tokenize
 
+from cache_keys import content_keyed_path
+
 nltk.download('punkt', quiet=True)
 
+PROMPT_TABLE_DIR = "data/paper_html_10.1038/abs_annotation/prompt_tables"
+PROMPT_TABLE_VERSION = 1    # bump when the table's columns or word counting change
+
 def word_count(text):
     words = word_tokenize(text)
     return len(words)
 
+def render_prompt(abstract, n_words):
+    return '[Abstract] ' + abstract + f'[Word count: {n_words}]'
+
+def prompt_table_path(tsv_path):
+    # The rendered template is part of the key, so editing render_prompt invalidates old tables
+    return content_keyed_path(PROMPT_TABLE_DIR, tsv_path, ".parquet", version=PROMPT_TABLE_VERSION,
+                              template=render_prompt("{abstract}", "{n_words}"))
+
+def build_prompt_table(tsv_path, workers=None):
+    """Tokenises every annotation once and stores word counts and rendered prompts.
+
+    The table has one row per TSV row (columns: row, abs_doi, word_count, prompt)
+    and is written next to the other abs_annotation data as parquet.
+    """
+    df = pd.read_csv(tsv_path, sep="\t")
+    annotations = df["annotation"].fillna("").astype(str).tolist()
+    with Pool(workers or os.cpu_count()) as pool:
+        counts = pool.map(word_count, annotations, chunksize=64)
+    table = pd.DataFrame({
+        "row": range(len(df)),
+        "abs_doi": df["abs_doi"] if "abs_doi" in df else None,
+        "word_count": counts,
+        "prompt": [render_prompt(a, n) for a, n in zip(df["abstract"], counts)],
+    })
+    out_path = prompt_table_path(tsv_path)
+    os.makedirs(PROMPT_TABLE_DIR, exist_ok=True)
+    table.to_parquet(out_path, index=False)
+    return table
+
+def load_prompt_table(tsv_path, workers=None):
+    """Loads the prompt table for tsv_path, building it first if it does not exist yet."""
+    path = prompt_table_path(tsv_path)
+    if os.path.exists(path):
+        return pd.read_parquet(path)
+    print(f"Building prompt table for {tsv_path} ...")
+    return build_prompt_table(tsv_path, workers)
+
 if __name__ == "__main__":
-    user_input = input("Enter text: ")
-    count = word_count(user_input)
-    print(f"Word count: {count}")
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Count words, or precompute the prompt table used by gen_llm_sum.py")
+    parser.add_argument("--prompt_table", type=str, nargs="*", default=None,
+                        help="TSV files to build prompt tables for (default: the test set variants)")
+    parser.add_argument("--workers", type=int, default=None, help="Tokenisation processes (default: all CPUs)")
+    args = parser.parse_args()
+
+    if args.prompt_table is None:
+        user_input = input("Enter text: ")
+        count = word_count(user_input)
+        print(f"Word count: {count}")
+    else:
+        tsv_paths = args.prompt_table or [
+            f"data/paper_html_10.1038/abs_annotation/{name}.tsv"
+            for name in ("test", "test_sent_shuffle", "test_tail")
+        ]
+        for tsv_path in tsv_paths:
+            if not os.path.exists(tsv_path):
+                print(f"Skipping missing {tsv_path}")
+                continue
+            table = build_prompt_table(tsv_path, args.workers)
+            print(f"{tsv_path}: {len(table)} prompts -> {prompt_table_path(tsv_path)}")